@@ -1,9 +1,12 @@
 import argparse
 from datetime import datetime, timedelta
 from game import ONITAMA_CARDS, Game, OnitamaAI, Point
+from game.ai import selective_search_options
+from game.record import GameRecordWriter
 
 
 def run_game(args):
+    """Plays one AI vs AI game. Returns (moves played, winner)."""
     max_turns = args.max_turns
     time_limit_ms = args.time_limit_ms
 
@@ -12,10 +15,22 @@ def run_game(args):
     else:
         g = Game()
 
-    red_ai = OnitamaAI(g, 0, args.red)
-    blue_ai = OnitamaAI(g, 1, args.blue)
+    red_ai = OnitamaAI(g, 0, args.red, solver_nodes=args.solver_nodes, **selective_search_options(args.red_selective))
+    blue_ai = OnitamaAI(g, 1, args.blue, solver_nodes=args.solver_nodes, **selective_search_options(args.blue_selective))
 
-    print("Red is", args.red, "Blue is", args.blue)
+    if not args.quiet:
+        print("Red is", args.red, args.red_selective, "Blue is", args.blue, args.blue_selective)
+
+    recorder = None
+    if args.record:
+        recorder = GameRecordWriter(args.record)
+        recorder.start_game(g, args.red, args.blue, time_limit_ms, args.depth_limit, args.solver_nodes,
+                            args.red_selective, args.blue_selective)
+
+    def end_recording(winner):
+        if recorder:
+            recorder.end_game(winner)
+            recorder.close()
 
     for i in range(max_turns):
         if args.verbose:
@@ -26,45 +41,63 @@ def run_game(args):
             if args.verbose:
                 print("Red AI is thinking...")
             now = datetime.now()
-            ai_move, best_score, depth = red_ai.decide_move(think_time=time_limit_ms, verbose=args.verbose)
+            red_ai.nodes = 0
+            ai_move, best_score, depth = red_ai.decide_move(args.depth_limit, time_limit_ms, verbose=args.verbose)
             g.apply_move(ai_move)
+            if recorder:
+                recorder.record_move(ai_move, best_score, depth, red_ai.nodes)
             if args.verbose:
                 print("AI plays", ai_move, f"(Evaluation: {best_score} at depth {depth})")
                 print("AI took", (datetime.now() - now).total_seconds(), "s")
 
             if g.determine_winner() == -1:
-                print(g.visualize())
-                print("Red wins!")
-                return i
+                if not args.quiet:
+                    print(g.visualize())
+                    print("Red wins!")
+                end_recording(-1)
+                return i, -1
         else:
             if args.verbose:
                 print("Blue AI is thinking...")
             now = datetime.now()
-            ai_move, best_score, depth = blue_ai.decide_move(think_time=time_limit_ms, verbose=args.verbose)
+            blue_ai.nodes = 0
+            ai_move, best_score, depth = blue_ai.decide_move(args.depth_limit, time_limit_ms, verbose=args.verbose)
             g.apply_move(ai_move)
+            if recorder:
+                recorder.record_move(ai_move, best_score, depth, blue_ai.nodes)
             if args.verbose:
                 print("AI plays", ai_move, f"(Evaluation: {best_score} at depth {depth})")
                 print("AI took", (datetime.now() - now).total_seconds(), "s")
 
             if g.determine_winner() == 1:
-                print(g.visualize())
-                print("Blue wins!")
-                return i
-    print(g.visualize())
-    print("Draw due to round limit")
-    return i
+                if not args.quiet:
+                    print(g.visualize())
+                    print("Blue wins!")
+                end_recording(1)
+                return i, 1
+    if not args.quiet:
+        print(g.visualize())
+        print("Draw due to round limit")
+    end_recording(0)
+    return i, 0
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-l", "--load_state", default=None, type=int)
     parser.add_argument("--red", default=0, help="0 for piece evaluation, 2 for combined", type=int)
     parser.add_argument("--blue", default=0, help="0 for piece evaluation, 2 for combined", type=int)
+    parser.add_argument("--red_selective", default="", help="comma separated selective search options: lmr, null, futility")
+    parser.add_argument("--blue_selective", default="", help="comma separated selective search options: lmr, null, futility")
+    parser.add_argument("--solver_nodes", default=0, help="node budget of the forced win search run before each move, 0 to skip it", type=int)
     parser.add_argument("-t", "--time_limit_ms", default=10000, type=int)
+    parser.add_argument("-d", "--depth_limit", default=1000, help="search depth limit per move", type=int)
     parser.add_argument("-m", "--max_turns", default=50, type=int)
     parser.add_argument("-v", "--verbose", default=False, action="store_true")
+    parser.add_argument("-q", "--quiet", default=False, action="store_true", help="do not print the players and final position")
+    parser.add_argument("-r", "--record", default=None, help="append the game to this binary game record file")
 
     args = parser.parse_args()
 
     start = datetime.now()
-    num_moves = run_game(args)
-    print("Game took", (datetime.now() - start).total_seconds(), "s and", num_moves, "moves")
\ No newline at end of file
+    num_moves, _ = run_game(args)
+    print("Game took", (datetime.now() - start).total_seconds(), "s and", num_moves, "moves")
\ No newline at end of file
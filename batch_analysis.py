@@ -0,0 +1,190 @@
+"""Analyses many serialized positions in parallel and streams one JSON result per line.
+
+Input lines hold Game.serialize() values, optionally prefixed with "serialized:" as printed by
+Game.visualize. Blank lines and lines starting with # are skipped.
+
+    python3 batch_analysis.py positions.txt -o results.jsonl -j 8 -t 500
+    python3 batch_analysis.py - -d 5 --unordered < positions.txt
+"""
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from game import Game, OnitamaAI
+from game.ai import SHARED_EVALUATION_CACHE
+
+# each worker keeps its AI, and therefore its state cache, between positions
+_worker_ai = None
+
+
+def init_worker(evaluation_mode, max_cache_size):
+    global _worker_ai
+    _worker_ai = OnitamaAI(None, 0, evaluation_mode, max_cache_size)
+    SHARED_EVALUATION_CACHE.resize(max_cache_size)
+
+
+def parse_position(line):
+    """Returns the serialized position on an input line, or None if the line should be skipped"""
+    line = line.strip()
+    if line.startswith("serialized:"):
+        line = line[len("serialized:"):].strip()
+    if not line or line.startswith("#"):
+        return None
+    return int(line)
+
+
+def analyse_position(index, serialized, depth_limit, think_time):
+    result = {"index": index, "serialized": serialized}
+    try:
+        game = Game.from_serialized(serialized)
+        game.validate()
+    except (IndexError, KeyError, ValueError) as e:
+        result["error"] = f"invalid position ({e})"
+        return result
+
+    winner = game.determine_winner()
+    if winner:
+        result.update(best_move=None, move=None, score=winner * Game.WIN_SCORE, depth=0, nodes=0, time_ms=0)
+        return result
+
+    ai = _worker_ai
+    ai.game = game
+    ai.nodes = 0
+    start = datetime.now()
+    try:
+        move, score, depth = ai.best_move(ai.evaluate_moves(depth_limit, think_time))
+    except Exception as e:
+        # one bad position is reported in its own result instead of ending the whole run
+        result["error"] = f"analysis failed ({type(e).__name__}: {e})"
+        return result
+    result.update(best_move=move.serialize(), move=str(move), score=score, depth=depth, nodes=ai.nodes,
+                  time_ms=int((datetime.now() - start).total_seconds() * 1000))
+    return result
+
+
+def read_positions(lines, skip_indices):
+    """Yields (index, serialized) for every position that still needs analysis"""
+    index = 0
+    for line in lines:
+        try:
+            serialized = parse_position(line)
+        except ValueError:
+            print("Skipping invalid line", line.strip(), file=sys.stderr)
+            continue
+        if serialized is None:
+            continue
+        if index not in skip_indices:
+            yield index, serialized
+        index += 1
+
+
+def completed_indices(path):
+    """Indices already present in a previous output file, for resuming"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["index"])
+            except (ValueError, KeyError):
+                # a partially written last line from an interrupted run
+                pass
+    return done
+
+
+def truncate_partial_line(path):
+    """Cuts an interrupted run's output back to its last complete line so appended results start on a new line"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        # scan back from the end in blocks rather than reading a large output file whole
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
+
+
+def run_batch(args):
+    skip_indices = set()
+    if args.output != "-" and args.resume:
+        skip_indices = completed_indices(args.output)
+        truncate_partial_line(args.output)
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = open(args.output, "a" if args.resume else "w")
+    lines = sys.stdin if args.input == "-" else open(args.input)
+    # a depth-only budget should not be cut short by the default think time
+    think_time = args.time_limit_ms or 10 ** 9
+    jobs = args.jobs or os.cpu_count()
+    # bounds the number of positions held in memory, whether queued, running or waiting to be written
+    max_in_flight = jobs * args.queue_factor
+
+    start = datetime.now()
+    count = 0
+    with ProcessPoolExecutor(jobs, initializer=init_worker,
+                             initargs=(args.evaluation, args.cache_size)) as executor:
+        in_flight = deque()
+        positions = read_positions(lines, skip_indices)
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    index, serialized = next(positions)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight.append(executor.submit(analyse_position, index, serialized, args.depth, think_time))
+            if not in_flight:
+                break
+
+            if args.unordered:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                finished = [future for future in in_flight if future in done]
+                for future in finished:
+                    in_flight.remove(future)
+            else:
+                finished = [in_flight.popleft()]
+            for future in finished:
+                output.write(json.dumps(future.result()) + "\n")
+                count += 1
+            output.flush()
+
+    elapsed = (datetime.now() - start).total_seconds()
+    print("Analysed", count, "positions in", elapsed, "s", file=sys.stderr)
+    if output is not sys.stdout:
+        output.close()
+    if lines is not sys.stdin:
+        lines.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="file of serialized positions, or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL output file, or - for stdout")
+    parser.add_argument("-j", "--jobs", default=None, help="worker processes, defaults to the number of cores", type=int)
+    parser.add_argument("-t", "--time_limit_ms", default=None, help="think time per position", type=int)
+    parser.add_argument("-d", "--depth", default=1000, help="depth limit per position", type=int)
+    parser.add_argument("-e", "--evaluation", default=0, help="0 for piece evaluation, 1 for centre priority, 2 for combination of both", type=int)
+    parser.add_argument("--cache_size", default=1000000, help="state cache entries per worker before it is cleared, also the size of each worker's evaluation cache, 0 for no limit", type=int)
+    parser.add_argument("--queue_factor", default=4, help="positions in flight per worker", type=int)
+    parser.add_argument("--unordered", default=False, action="store_true", help="write results as they complete instead of in input order")
+    parser.add_argument("--resume", default=False, action="store_true", help="skip positions already in the output file and append to it")
+
+    args = parser.parse_args()
+    if args.time_limit_ms is None and args.depth == 1000:
+        parser.error("set a time limit (-t) or a depth limit (-d)")
+    if args.cache_size < 0:
+        parser.error("--cache_size must not be negative, 0 keeps every entry")
+
+    run_batch(args)
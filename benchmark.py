@@ -0,0 +1,155 @@
+"""Repeatable performance benchmarks for the engine and search.
+
+Times the engine primitives and the AI's time to depth on fixed reference positions, writes the
+results to JSON and optionally compares them against a stored baseline. Baselines recorded with different
+settings are refused (exit status 2), since their timings are not comparable.
+
+    python3 benchmark.py -o baseline.json
+    python3 benchmark.py --baseline baseline.json --threshold 0.1
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import timeit
+from datetime import datetime
+from game import Game, OnitamaAI
+from game.ai import EvaluationCache, selective_search_options
+
+REFERENCE_POSITIONS = {
+    "opening": Game.from_string("rrRrr\n.....\n.....\n.....\nbbBbb",
+                                red_cards=["crab", "crane"], blue_cards=["mantis", "rooster"],
+                                neutral_card="goose", starting_player=1),
+    "midgame": Game.from_string("r.R.r\n..r..\n.b..r\nb.B..\n...b.",
+                                red_cards=["tiger", "frog"], blue_cards=["monkey", "ox"],
+                                neutral_card="boar", starting_player=0),
+    "crowded": Game.from_string(".rRr.\nr...r\n.b.b.\n..B..\n.b.b.",
+                                red_cards=["dragon", "eel"], blue_cards=["elephant", "cobra"],
+                                neutral_card="horse", starting_player=1),
+    "endgame": Game.from_string("..R..\n.....\n..b..\n.r...\n...B.",
+                                red_cards=["rabbit", "goose"], blue_cards=["crab", "monkey"],
+                                neutral_card="mantis", starting_player=1),
+}
+
+
+def time_per_call(function, number, repeat):
+    """Best time of repeat runs, divided by the number of calls in each run"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def benchmark_engine(results, number, repeat):
+    for name, game in REFERENCE_POSITIONS.items():
+        moves = list(game.legal_moves())
+        serialized = game.serialize()
+
+        def apply_moves():
+            for move in moves:
+                game.copy().apply_move(move)
+
+        results[f"legal_moves/{name}"] = {"seconds": time_per_call(lambda: list(game.legal_moves()), number, repeat)}
+        results[f"copy/{name}"] = {"seconds": time_per_call(game.copy, number, repeat)}
+        results[f"copy_apply_move/{name}"] = {"seconds": time_per_call(apply_moves, number, repeat) / len(moves)}
+        results[f"serialize/{name}"] = {"seconds": time_per_call(game.serialize, number, repeat)}
+        results[f"from_serialized/{name}"] = {
+            "seconds": time_per_call(lambda: Game.from_serialized(serialized), number, repeat)}
+        results[f"has_winning_move/{name}"] = {"seconds": time_per_call(game.has_winning_move, number, repeat)}
+        for mode in range(3):
+            results[f"evaluate_{mode}/{name}"] = {
+                "seconds": time_per_call(lambda: game.evaluate(mode), number, repeat)}
+
+
+def benchmark_search(results, depth, evaluation_mode, selective, seed, repeat):
+    for name, game in REFERENCE_POSITIONS.items():
+        # fastest time to each depth over several searches starting from an empty cache
+        depth_times = {}
+        for _ in range(repeat):
+            random.seed(seed)
+            ai = OnitamaAI(game.copy(), game.current_player, evaluation_mode, evaluation_cache=EvaluationCache(),
+                           **selective_search_options(selective))
+            start = datetime.now()
+
+            def record_depth(completed_depth, moves):
+                seconds = (datetime.now() - start).total_seconds()
+                if completed_depth not in depth_times or seconds < depth_times[completed_depth][0]:
+                    depth_times[completed_depth] = (seconds, ai.nodes)
+
+            ai.evaluate_moves(depth, 10 ** 9, info_callback=record_depth)
+        for completed_depth, (seconds, nodes) in depth_times.items():
+            results[f"search_depth_{completed_depth}/{name}"] = {
+                "seconds": seconds, "nodes": nodes, "nps": int(nodes / max(seconds, 1e-9))}
+
+
+def compare(results, baseline, threshold):
+    """Returns the names of benchmarks slower than baseline by more than threshold"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]["seconds"], result["seconds"]
+        change = new / old - 1 if old else 0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:40} {old * 1e6:12.2f}us {new * 1e6:12.2f}us {change:+8.1%}{flag}")
+    return regressions
+
+
+def mismatched_settings(settings, baseline_settings):
+    """Names of settings that differ from the baseline's, whose timings are then not comparable"""
+    return sorted(name for name in set(settings) | set(baseline_settings)
+                  if settings.get(name) != baseline_settings.get(name))
+
+
+def run_benchmarks(args):
+    results = {}
+    benchmark_engine(results, args.number, args.repeat)
+    benchmark_search(results, args.depth, args.evaluation, args.selective, args.seed, args.search_repeat)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "settings": {"number": args.number, "repeat": args.repeat, "depth": args.depth,
+                     "evaluation": args.evaluation, "selective": args.selective, "seed": args.seed,
+                     "search_repeat": args.search_repeat},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatched = mismatched_settings(report["settings"], baseline.get("settings", {}))
+        if mismatched:
+            print("Not comparing, settings differ from the baseline:",
+                  ", ".join(f"{name} {baseline.get('settings', {}).get(name)!r} -> {report['settings'].get(name)!r}"
+                            for name in mismatched), file=sys.stderr)
+            return 2
+        regressions = compare(results, baseline["results"], args.threshold)
+        print(len(regressions), "regressions beyond", f"{args.threshold:.0%}")
+        return 1 if regressions else 0
+
+    for name, result in results.items():
+        extra = f" {result['nodes']} nodes {result['nps']} nodes/s" if "nodes" in result else ""
+        print(f"{name:40} {result['seconds'] * 1e6:12.2f}us{extra}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default=None, help="write results to this JSON file")
+    parser.add_argument("-b", "--baseline", default=None, help="compare against results from this JSON file")
+    parser.add_argument("--threshold", default=0.1, help="relative slowdown reported as a regression", type=float)
+    parser.add_argument("-n", "--number", default=1000, help="calls per timing run of engine functions", type=int)
+    parser.add_argument("-r", "--repeat", default=5, help="timing runs, the fastest is kept", type=int)
+    parser.add_argument("--search_repeat", default=3, help="searches per position, the fastest is kept", type=int)
+    parser.add_argument("-d", "--depth", default=4, help="search depth for the AI benchmarks", type=int)
+    parser.add_argument("-e", "--evaluation", default=0, help="0 for piece evaluation, 1 for centre priority, 2 for combination of both", type=int)
+    parser.add_argument("-s", "--selective", default="", help="comma separated selective search options: lmr, null, futility")
+    parser.add_argument("--seed", default=0, type=int)
+
+    args = parser.parse_args()
+
+    sys.exit(run_benchmarks(args))
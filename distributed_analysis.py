@@ -0,0 +1,296 @@
+"""Spreads batch position analysis over several machines.
+
+A coordinator reads serialized positions (in the same format as batch_analysis.py) and hands them
+out in chunks over TCP. Workers analyse each chunk with OnitamaAI and send the results back, which
+the coordinator streams to a JSONL file. Messages are newline-delimited JSON.
+
+Workers announce how many chunks they will hold at once, which bounds the work queued on each of
+them, and the coordinator only reads ahead a bounded number of chunks from the input. Workers send
+heartbeats while they search, and chunks held by a worker that disconnects or stops sending
+heartbeats are queued again, up to --max_attempts times before its positions are written as errors.
+
+    python3 distributed_analysis.py coordinator positions.txt -o results.jsonl -t 500 --port 8487
+    python3 distributed_analysis.py worker --host coordinator.local --port 8487
+
+Pass --spawn_workers N to the coordinator to run N workers on this machine.
+"""
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from batch_analysis import analyse_position, completed_indices, init_worker, read_positions, truncate_partial_line
+
+
+async def send_message(writer, message):
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+
+
+class WorkerConnection:
+    def __init__(self, worker_id, writer):
+        self.id = worker_id
+        self.writer = writer
+        self.slots = 1
+        # chunk id -> chunk held by this worker
+        self.chunks = {}
+        self.last_seen = time.monotonic()
+
+
+class Coordinator:
+    def __init__(self, args):
+        self.args = args
+        self.positions = None
+        self.input_exhausted = False
+        self.next_chunk_id = 0
+        # chunks read from the input or re-queued, waiting for a worker
+        self.queue = deque()
+        self.workers = {}
+        self.next_worker_id = 0
+        self.output = None
+        self.results_written = 0
+        self.finished = None
+        # connection handler tasks, awaited on shutdown so workers can close cleanly
+        self.handlers = set()
+        # chunk id -> workers lost while holding it
+        self.failures = {}
+
+    def fill_queue(self):
+        """Reads ahead at most max_queued_chunks chunks of the input"""
+        while not self.input_exhausted and len(self.queue) < self.args.max_queued_chunks:
+            chunk = []
+            for index, serialized in self.positions:
+                chunk.append((index, serialized))
+                if len(chunk) == self.args.chunk_size:
+                    break
+            else:
+                self.input_exhausted = True
+            if chunk:
+                self.queue.append((self.next_chunk_id, chunk))
+                self.next_chunk_id += 1
+
+    def work_remaining(self):
+        return self.queue or not self.input_exhausted or any(worker.chunks for worker in self.workers.values())
+
+    async def dispatch(self):
+        """Hands queued chunks to workers with free slots"""
+        self.fill_queue()
+        for worker in list(self.workers.values()):
+            while self.queue and len(worker.chunks) < worker.slots:
+                chunk_id, chunk = self.queue.popleft()
+                worker.chunks[chunk_id] = chunk
+                try:
+                    await send_message(worker.writer, {"type": "work", "chunk": chunk_id, "positions": chunk})
+                except ConnectionError:
+                    self.drop_worker(worker)
+                    break
+            self.fill_queue()
+        if not self.work_remaining():
+            self.finished.set()
+
+    def drop_worker(self, worker):
+        if self.workers.pop(worker.id, None) is None:
+            return
+        if worker.chunks:
+            print("Worker", worker.id, "lost, re-queueing", len(worker.chunks), "chunks", file=sys.stderr)
+        # lost work goes to the front so results are not held back behind the rest of the input
+        for chunk_id, chunk in reversed(list(worker.chunks.items())):
+            self.failures[chunk_id] = self.failures.get(chunk_id, 0) + 1
+            if self.failures[chunk_id] >= self.args.max_attempts:
+                # a chunk that keeps taking workers down would otherwise crash every worker in turn
+                print("Chunk", chunk_id, "failed on", self.failures[chunk_id], "workers, giving up", file=sys.stderr)
+                self.write_results([{"index": index, "serialized": serialized,
+                                     "error": f"lost {self.failures[chunk_id]} workers while analysing its chunk"}
+                                    for index, serialized in chunk])
+            else:
+                self.queue.appendleft((chunk_id, chunk))
+        worker.chunks.clear()
+        worker.writer.close()
+
+    def write_results(self, results):
+        for result in results:
+            self.output.write(json.dumps(result) + "\n")
+        self.output.flush()
+        self.results_written += len(results)
+
+    async def handle_worker(self, reader, writer):
+        worker = WorkerConnection(self.next_worker_id, writer)
+        self.next_worker_id += 1
+        self.handlers.add(asyncio.current_task())
+        try:
+            await send_message(writer, {"type": "settings", "depth": self.args.depth,
+                                        "think_time": self.args.time_limit_ms or 10 ** 9,
+                                        "evaluation": self.args.evaluation, "cache_size": self.args.cache_size})
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                worker.last_seen = time.monotonic()
+                if message["type"] == "ready":
+                    worker.slots = max(1, int(message.get("slots", 1)))
+                    self.workers[worker.id] = worker
+                elif message["type"] == "result":
+                    if worker.chunks.pop(message["chunk"], None) is None:
+                        # the chunk was already re-queued after a missed heartbeat
+                        continue
+                    self.failures.pop(message["chunk"], None)
+                    self.write_results(message["results"])
+                await self.dispatch()
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            self.drop_worker(worker)
+            self.handlers.discard(asyncio.current_task())
+            await self.dispatch()
+
+    async def watch_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.args.heartbeat_timeout / 2)
+            now = time.monotonic()
+            for worker in list(self.workers.values()):
+                if now - worker.last_seen > self.args.heartbeat_timeout:
+                    self.drop_worker(worker)
+            await self.dispatch()
+
+    async def run(self):
+        args = self.args
+        skip_indices = set()
+        if args.output != "-" and args.resume:
+            skip_indices = completed_indices(args.output)
+            truncate_partial_line(args.output)
+        self.output = sys.stdout if args.output == "-" else open(args.output, "a" if args.resume else "w")
+        lines = sys.stdin if args.input == "-" else open(args.input)
+        self.positions = read_positions(lines, skip_indices)
+        self.finished = asyncio.Event()
+        self.fill_queue()
+
+        server = await asyncio.start_server(self.handle_worker, args.host, args.port)
+        port = server.sockets[0].getsockname()[1]
+        print("Coordinator listening on port", port, file=sys.stderr)
+        spawned = [subprocess.Popen([sys.executable, __file__, "worker", "--host", "127.0.0.1", "--port", str(port)])
+                   for _ in range(args.spawn_workers)]
+
+        start = datetime.now()
+        watchdog = asyncio.ensure_future(self.watch_heartbeats())
+        if not self.work_remaining():
+            self.finished.set()
+        await self.finished.wait()
+        watchdog.cancel()
+
+        for worker in list(self.workers.values()):
+            try:
+                await send_message(worker.writer, {"type": "done"})
+            except ConnectionError:
+                pass
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=args.heartbeat_timeout)
+        server.close()
+        await server.wait_closed()
+        for process in spawned:
+            process.wait()
+
+        print("Analysed", self.results_written, "positions in", (datetime.now() - start).total_seconds(), "s",
+              file=sys.stderr)
+        if self.output is not sys.stdout:
+            self.output.close()
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def analyse_chunk_position(index, serialized, settings):
+    # a position that breaks the analysis becomes an error result rather than taking the worker down
+    try:
+        return analyse_position(index, serialized, settings["depth"], settings["think_time"])
+    except Exception as e:
+        return {"index": index, "serialized": serialized, "error": f"analysis failed ({type(e).__name__}: {e})"}
+
+
+def run_worker(args):
+    for attempt in range(args.retries):
+        try:
+            connection = socket.create_connection((args.host, args.port))
+            break
+        except OSError:
+            time.sleep(1)
+    else:
+        print("Could not connect to coordinator", f"{args.host}:{args.port}", file=sys.stderr)
+        return
+
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message):
+        with send_lock:
+            connection.sendall(json.dumps(message).encode() + b"\n")
+
+    def heartbeat():
+        while not stopped.wait(args.heartbeat_interval):
+            try:
+                send({"type": "heartbeat"})
+            except OSError:
+                return
+
+    with connection, connection.makefile("r") as messages:
+        settings = json.loads(messages.readline())
+        init_worker(settings["evaluation"], settings["cache_size"])
+        threading.Thread(target=heartbeat, daemon=True).start()
+        send({"type": "ready", "slots": args.prefetch})
+        try:
+            for line in messages:
+                message = json.loads(line)
+                if message["type"] == "done":
+                    break
+                if message["type"] == "work":
+                    results = [analyse_chunk_position(index, serialized, settings)
+                               for index, serialized in message["positions"]]
+                    send({"type": "result", "chunk": message["chunk"], "results": results})
+        except OSError:
+            pass
+        finally:
+            stopped.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    coordinator = subparsers.add_parser("coordinator")
+    coordinator.add_argument("input", help="file of serialized positions, or - for stdin")
+    coordinator.add_argument("-o", "--output", default="-", help="JSONL output file, or - for stdout")
+    coordinator.add_argument("--host", default="0.0.0.0")
+    coordinator.add_argument("--port", default=8487, help="0 picks a free port", type=int)
+    coordinator.add_argument("-t", "--time_limit_ms", default=None, help="think time per position", type=int)
+    coordinator.add_argument("-d", "--depth", default=1000, help="depth limit per position", type=int)
+    coordinator.add_argument("-e", "--evaluation", default=0, help="0 for piece evaluation, 1 for centre priority, 2 for combination of both", type=int)
+    coordinator.add_argument("--cache_size", default=1000000, help="state cache entries per worker before it is cleared, also the size of each worker's evaluation cache, 0 for no limit", type=int)
+    coordinator.add_argument("--chunk_size", default=16, help="positions per chunk of work", type=int)
+    coordinator.add_argument("--max_queued_chunks", default=64, help="chunks read ahead of the workers", type=int)
+    coordinator.add_argument("--heartbeat_timeout", default=30, help="seconds without a message before a worker's chunks are re-queued", type=float)
+    coordinator.add_argument("--resume", default=False, action="store_true", help="skip positions already in the output file and append to it")
+    coordinator.add_argument("--max_attempts", default=3, help="workers a chunk may be lost on before its positions are written as errors", type=int)
+    coordinator.add_argument("--spawn_workers", default=0, help="worker processes to start on this machine", type=int)
+
+    worker = subparsers.add_parser("worker")
+    worker.add_argument("--host", default="127.0.0.1")
+    worker.add_argument("--port", default=8487, type=int)
+    worker.add_argument("--prefetch", default=2, help="chunks held at once, so the next is ready when one finishes", type=int)
+    worker.add_argument("--heartbeat_interval", default=5, help="seconds between heartbeats", type=float)
+    worker.add_argument("--retries", default=10, help="attempts to connect to the coordinator, one second apart", type=int)
+
+    args = parser.parse_args()
+
+    if args.mode == "coordinator":
+        if args.time_limit_ms is None and args.depth == 1000:
+            parser.error("set a time limit (-t) or a depth limit (-d)")
+        if args.cache_size < 0:
+            parser.error("--cache_size must not be negative, 0 keeps every entry")
+        asyncio.run(Coordinator(args).run())
+    else:
+        run_worker(args)
@@ -0,0 +1,252 @@
+"""Line-based engine protocol in the spirit of UCI, so GUIs and scripts can drive the AI
+from one long-lived process that keeps its caches warm between requests.
+
+Positions are Game.serialize() values and moves are Move.serialize() values.
+
+    uci                                     -> id lines, option lines, uciok
+    isready                                 -> readyok
+    newgame                                 clears caches
+    position <serialized> [moves <m> ...]   sets the position, optionally applying moves
+    setoption name <name> value <value>     Evaluation (0, 1 or 2), CacheSize (entries in the state and
+                                            evaluation caches, 0 = unbounded)
+                                            or MultiPV (moves given exact scores and their own info lines)
+    go [movetime <ms>] [depth <n>] [infinite]
+    ponder                                  searches the current position until stop
+    solve [nodes <n>] [plies <n>]           proof-number search for a forced win or loss
+                                            -> solution win|loss|unknown nodes <n> line <m> ...
+    stop                                    ends the search and prints bestmove
+    display                                 prints the current position
+    quit
+
+Commands sent during a timed or depth limited search wait for it to finish, while ponder and
+go infinite searches are stopped by them. While searching, info lines report depth, score, nodes,
+nps, time and pv after each iteration, followed by bestmove <move> when the search ends.
+"""
+import sys
+import threading
+from datetime import datetime
+from game import Game, Move, OnitamaAI
+from game.solver import DEFAULT_MAX_NODES, DEFAULT_MAX_PLIES, ProofNumberSolver
+
+DEFAULT_MOVETIME_MS = 1000
+INFINITE_MOVETIME_MS = 10 ** 9
+MAX_DEPTH = 1000
+
+
+class EngineProtocol:
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.game = None
+        self.ai = OnitamaAI(None, 0, 0)
+        self.search_thread = None
+        self.search_infinite = False
+        self.multipv = 1
+        # kept between solves so proven positions are remembered
+        self.solver = ProofNumberSolver()
+
+    def send(self, line):
+        with self.output_lock:
+            print(line, file=self.output, flush=True)
+
+    def handle(self, line):
+        """Handles a single command line. Returns False once the engine should exit."""
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, params = tokens[0], tokens[1:]
+
+        if command in ("stop", "quit"):
+            self.stop_search()
+            return command != "quit"
+        if command == "isready":
+            self.send("readyok")
+            return True
+        # every other command changes engine state, so finish any search first
+        if self.search_infinite:
+            self.stop_search()
+        else:
+            self.wait_search()
+
+        if command == "uci":
+            self.send("id name Onitama-AI")
+            self.send("option name Evaluation type spin default 0 min 0 max 2")
+            self.send("option name CacheSize type spin default 0 min 0")
+            self.send("option name MultiPV type spin default 1 min 1")
+            self.send("uciok")
+        elif command in ("newgame", "ucinewgame"):
+            self.ai.state_cache.clear()
+            self.solver.table.clear()
+            self.game = None
+        elif command == "position":
+            self.set_position(params)
+        elif command == "setoption":
+            self.set_option(params)
+        elif command == "go":
+            self.go(params)
+        elif command == "solve":
+            self.solve(params)
+        elif command == "ponder":
+            self.start_search(MAX_DEPTH, INFINITE_MOVETIME_MS, infinite=True)
+        elif command == "display":
+            if self.game is None:
+                self.send("info string no position")
+            else:
+                self.send(self.game.visualize())
+        else:
+            self.send(f"info string unknown command {command}")
+        return True
+
+    def set_position(self, params):
+        try:
+            game = Game.from_serialized(int(params[0]))
+            game.validate()
+            if len(params) > 1:
+                if params[1] != "moves":
+                    raise ValueError(params[1])
+                for token in params[2:]:
+                    move = Move.from_serialized(int(token))
+                    if move not in game.legal_moves():
+                        raise ValueError(token)
+                    game.apply_move(move)
+        except (IndexError, ValueError, KeyError) as e:
+            self.send(f"info string invalid position {' '.join(params)} ({e})")
+            # searching the previous position instead would answer the wrong question
+            self.game = None
+            return
+        self.game = game
+
+    def set_option(self, params):
+        # setoption name <name> value <value>
+        if len(params) != 4 or params[0] != "name" or params[2] != "value":
+            self.send(f"info string invalid setoption {' '.join(params)}")
+            return
+        name, value = params[1].lower(), params[3]
+        try:
+            if name == "evaluation":
+                self.ai.evaluation_mode = int(value)
+                # cached scores came from the previous evaluation function
+                self.ai.state_cache.clear()
+            elif name == "cachesize":
+                # resize rejects negative sizes before the state cache limit changes
+                self.ai.evaluation_cache.resize(int(value))
+                self.ai.max_cache_size = int(value) or None
+            elif name == "multipv":
+                self.multipv = max(1, int(value))
+            else:
+                self.send(f"info string unknown option {params[1]}")
+        except ValueError:
+            self.send(f"info string invalid value {value}")
+
+    def go(self, params):
+        depth_limit = MAX_DEPTH
+        think_time = None
+        try:
+            i = 0
+            while i < len(params):
+                if params[i] == "infinite":
+                    think_time = INFINITE_MOVETIME_MS
+                    i += 1
+                elif params[i] == "movetime":
+                    think_time = int(params[i + 1])
+                    i += 2
+                elif params[i] == "depth":
+                    depth_limit = int(params[i + 1])
+                    i += 2
+                else:
+                    raise ValueError(params[i])
+        except (IndexError, ValueError) as e:
+            self.send(f"info string invalid go {' '.join(params)} ({e})")
+            return
+        if think_time is None:
+            # a depth-only search should not be cut short by the default time budget
+            think_time = INFINITE_MOVETIME_MS if depth_limit < MAX_DEPTH else DEFAULT_MOVETIME_MS
+        self.start_search(depth_limit, think_time, infinite=think_time == INFINITE_MOVETIME_MS and depth_limit == MAX_DEPTH)
+
+    def solve(self, params):
+        if self.game is None:
+            self.send("info string no position")
+            return
+        self.solver.max_nodes = DEFAULT_MAX_NODES
+        self.solver.max_plies = DEFAULT_MAX_PLIES
+        try:
+            for name, value in zip(params[::2], params[1::2]):
+                if name == "nodes":
+                    self.solver.max_nodes = int(value)
+                elif name == "plies":
+                    self.solver.max_plies = int(value)
+                else:
+                    raise ValueError(name)
+        except ValueError as e:
+            self.send(f"info string invalid solve {' '.join(params)} ({e})")
+            return
+        result = self.solver.solve(self.game)
+        line = " ".join(str(move.serialize()) for move in result.line)
+        self.send(f"solution {result.outcome} nodes {result.nodes} line {line}".rstrip())
+
+    def start_search(self, depth_limit, think_time, infinite=False):
+        if self.game is None:
+            self.send("info string no position")
+            return
+        self.ai.game = self.game
+        self.ai.stop_requested = False
+        self.search_infinite = infinite
+        self.search_thread = threading.Thread(target=self.search, args=(depth_limit, think_time), daemon=True)
+        self.search_thread.start()
+
+    def stop_search(self):
+        self.ai.stop_requested = True
+        self.wait_search()
+
+    def wait_search(self):
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+            self.search_infinite = False
+
+    def search(self, depth_limit, think_time):
+        start = datetime.now()
+        self.ai.nodes = 0
+        # move reported as the start of the pv by the last completed iteration, so bestmove agrees with it
+        reported_move = None
+
+        def report(depth, moves):
+            nonlocal reported_move
+            if self.multipv > 1:
+                lines = [(f"multipv {i + 1} ", move, score)
+                         for i, (move, score, _) in enumerate(self.ai.ranked_moves(moves, self.multipv))]
+            else:
+                move, score, _ = self.ai.best_move(moves)
+                lines = [("", move, score)]
+            reported_move = lines[0][1]
+            elapsed = max((datetime.now() - start).total_seconds(), 1e-6)
+            for multipv, move, score in lines:
+                pv = " ".join(str(m.serialize()) for m in self.ai.principal_variation(move, depth))
+                self.send(f"info depth {depth} {multipv}score {score} nodes {self.ai.nodes} "
+                          f"nps {int(self.ai.nodes / elapsed)} time {int(elapsed * 1000)} pv {pv}")
+
+        try:
+            moves = self.ai.evaluate_moves(depth_limit, think_time, info_callback=report, multipv=self.multipv)
+        except Exception as e:
+            # a GUI waits for bestmove, so one is sent even if the search fails
+            self.send(f"info string search failed ({type(e).__name__}: {e})")
+            moves = {}
+        if reported_move is not None:
+            self.send(f"bestmove {reported_move.serialize()}")
+        elif moves:
+            move, _, _ = self.ai.best_move(moves)
+            self.send(f"bestmove {move.serialize()}")
+        else:
+            self.send("bestmove none")
+
+
+def run_protocol(input=sys.stdin, output=sys.stdout):
+    engine = EngineProtocol(output)
+    for line in input:
+        if not engine.handle(line):
+            break
+    engine.stop_search()
+
+
+if __name__ == "__main__":
+    run_protocol()
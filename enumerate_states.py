@@ -0,0 +1,321 @@
+"""Counts the distinct positions reachable at each ply for one card deal.
+
+Game.serialize() values need about 121 bits, so positions are packed into two uint64 words
+instead. With the five cards of the deal fixed, the 30 ways to hold them fit in 5 bits:
+    word 0: player to move << 55 | card arrangement << 50 | red master << 25 | red pawns
+    word 1: blue master << 25 | blue pawns
+
+Each ply expands the previous frontier with vectorized move generation. Children are split into
+hash buckets and each bucket is deduplicated with np.unique. Buckets spill to disk once the
+children held in memory pass --max_states_in_memory, so a ply only needs one bucket in RAM at a time.
+Terminal positions are counted but not expanded. With --symmetry, positions that are left-right mirror
+images of each other are counted once.
+
+    python3 enumerate_states.py -p 6
+    python3 enumerate_states.py -l 1495381528682411417722191102608565721 -p 10 --symmetry --spill_dir /tmp/frontier
+"""
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from game import Game
+from game.engine_bitboard import BOARD_HEIGHT, BOARD_WIDTH
+
+U = np.uint64
+SQUARES = BOARD_WIDTH * BOARD_HEIGHT
+BOARD_MASK = U((1 << SQUARES) - 1)
+PLAYER_SHIFT = U(55)
+ARRANGEMENT_SHIFT = U(50)
+KING_SHIFT = U(SQUARES)
+HASH_MULTIPLIER = U(0x9E3779B97F4A7C15)
+STATE_DTYPE = np.dtype(np.uint64)
+
+
+class Deal:
+    def __init__(self, red_cards, blue_cards, neutral_card):
+        """The five cards of a game and every way they can be split between red, blue and the neutral slot"""
+        self.cards = list(red_cards) + list(blue_cards) + [neutral_card]
+        self.arrangements = []
+        for neutral in range(5):
+            others = [card for card in range(5) if card != neutral]
+            for red in itertools.combinations(others, 2):
+                blue = tuple(card for card in others if card not in red)
+                self.arrangements.append((red, blue, neutral))
+        self.arrangement_index = {arrangement: i for i, arrangement in enumerate(self.arrangements)}
+        self.start_arrangement = self.arrangement_index[((0, 1), (2, 3), 4)]
+        # next_arrangement[arrangement][player][slot] after player uses the card in that slot of their hand
+        self.next_arrangement = []
+        for red, blue, neutral in self.arrangements:
+            transitions = []
+            for player, hand in enumerate((red, blue)):
+                slots = []
+                for used in hand:
+                    new_hand = tuple(sorted([card for card in hand if card != used] + [neutral]))
+                    key = (new_hand, blue, used) if player == 0 else (red, new_hand, used)
+                    slots.append(self.arrangement_index[key])
+                transitions.append(slots)
+            self.next_arrangement.append(transitions)
+        # mirroring the board left to right swaps left and right-leaning cards, which is only a
+        # symmetry of the game if the mirror image of every card is also in the deal
+        mirror_card = {}
+        for i, card in enumerate(self.cards):
+            mirrored_moves = {(-move.x, move.y) for move in card.moves}
+            for j, other in enumerate(self.cards):
+                if {(move.x, move.y) for move in other.moves} == mirrored_moves:
+                    mirror_card[i] = j
+        self.mirror_symmetric = len(mirror_card) == 5
+        if self.mirror_symmetric:
+            self.mirrored_arrangement = np.array([
+                self.arrangement_index[(tuple(sorted(mirror_card[card] for card in red)),
+                                        tuple(sorted(mirror_card[card] for card in blue)), mirror_card[neutral])]
+                for red, blue, neutral in self.arrangements], dtype=np.uint64)
+
+    def hand(self, arrangement, player):
+        return self.arrangements[arrangement][player]
+
+
+def pack(player, arrangement, red_king, red_pawns, blue_king, blue_pawns):
+    states = np.empty((len(red_king), 2), dtype=STATE_DTYPE)
+    states[:, 0] = ((U(player) << PLAYER_SHIFT) | (U(arrangement) << ARRANGEMENT_SHIFT)
+                    | (red_king << KING_SHIFT) | red_pawns)
+    states[:, 1] = (blue_king << KING_SHIFT) | blue_pawns
+    return states
+
+
+def unpack(states):
+    word0, word1 = states[:, 0], states[:, 1]
+    return (word0 >> PLAYER_SHIFT, (word0 >> ARRANGEMENT_SHIFT) & U(31),
+            (word0 >> KING_SHIFT) & BOARD_MASK, word0 & BOARD_MASK,
+            (word1 >> KING_SHIFT) & BOARD_MASK, word1 & BOARD_MASK)
+
+
+def terminal_mask(states):
+    _, _, red_king, _, blue_king, _ = unpack(states)
+    return ((red_king == 0) | (blue_king == 0)
+            | (red_king == U(Game.WIN_BITMASK[0])) | (blue_king == U(Game.WIN_BITMASK[1])))
+
+
+def mirror_board(board):
+    """Mirrors boards left to right, which reverses the square indices within each row"""
+    result = np.zeros_like(board)
+    for i in range(SQUARES):
+        mirrored = i - i % BOARD_WIDTH + BOARD_WIDTH - 1 - i % BOARD_WIDTH
+        result |= ((board >> U(i)) & U(1)) << U(mirrored)
+    return result
+
+
+def canonicalize(states, deal):
+    """Maps each state and its mirror image to the same representative"""
+    player, arrangement, red_king, red_pawns, blue_king, blue_pawns = unpack(states)
+    mirrored = pack(0, 0, mirror_board(red_king), mirror_board(red_pawns), mirror_board(blue_king), mirror_board(blue_pawns))
+    mirrored[:, 0] |= (player << PLAYER_SHIFT) | (deal.mirrored_arrangement[arrangement] << ARRANGEMENT_SHIFT)
+    use_mirrored = ((mirrored[:, 0] < states[:, 0])
+                    | ((mirrored[:, 0] == states[:, 0]) & (mirrored[:, 1] < states[:, 1])))
+    return np.where(use_mirrored[:, None], mirrored, states)
+
+
+def expand(states, deal):
+    """Returns every child of the non-terminal states, with duplicates"""
+    states = states[~terminal_mask(states)]
+    player, arrangement, red_king, red_pawns, blue_king, blue_pawns = unpack(states)
+    children = []
+    groups = player * U(32) + arrangement
+    for group in np.unique(groups):
+        in_group = groups == group
+        p, a = int(group) // 32, int(group) % 32
+        kings = (red_king[in_group], blue_king[in_group])
+        pawns = (red_pawns[in_group], blue_pawns[in_group])
+        own_king, own_pawns = kings[p], pawns[p]
+        opponent_king, opponent_pawns = kings[1 - p], pawns[1 - p]
+        own = own_king | own_pawns
+        has_move = np.zeros(len(own), dtype=bool)
+
+        for slot, card_index in enumerate(deal.hand(a, p)):
+            move_table = deal.cards[card_index].move_table_list[p]
+            new_arrangement = deal.next_arrangement[a][p][slot]
+            for start in range(SQUARES):
+                start_mask = U(1 << start)
+                occupied = (own & start_mask) != 0
+                if not occupied.any():
+                    continue
+                destinations = move_table[start]
+                while destinations:
+                    end_mask = destinations & -destinations
+                    destinations ^= end_mask
+                    end_mask = U(end_mask)
+                    valid = occupied & ((own & end_mask) == 0)
+                    if not valid.any():
+                        continue
+                    has_move |= valid
+                    moved_king = (own_king[valid] & start_mask) != 0
+                    new_own_king = np.where(moved_king, (own_king[valid] & ~start_mask) | end_mask, own_king[valid])
+                    new_own_pawns = np.where(moved_king, own_pawns[valid], (own_pawns[valid] & ~start_mask) | end_mask)
+                    new_opponent_king = opponent_king[valid] & ~end_mask
+                    new_opponent_pawns = opponent_pawns[valid] & ~end_mask
+                    if p == 0:
+                        children.append(pack(1, new_arrangement, new_own_king, new_own_pawns,
+                                             new_opponent_king, new_opponent_pawns))
+                    else:
+                        children.append(pack(0, new_arrangement, new_opponent_king, new_opponent_pawns,
+                                             new_own_king, new_own_pawns))
+
+        if not has_move.all():
+            # no piece can move, so the player passes by exchanging either card
+            stuck = ~has_move
+            for slot in range(2):
+                children.append(pack(1 - p, deal.next_arrangement[a][p][slot], kings[0][stuck], pawns[0][stuck],
+                                     kings[1][stuck], pawns[1][stuck]))
+    if not children:
+        return np.empty((0, 2), dtype=STATE_DTYPE)
+    return np.concatenate(children)
+
+
+def unique_states(states):
+    if not len(states):
+        return states
+    rows = np.ascontiguousarray(states).view(np.dtype((np.void, 2 * STATE_DTYPE.itemsize)))
+    return np.unique(rows).view(STATE_DTYPE).reshape(-1, 2)
+
+
+class BucketStore:
+    def __init__(self, num_buckets, max_states_in_memory, spill_dir):
+        """Collects states into hash buckets, appending buckets to files in spill_dir when memory runs out"""
+        self.num_buckets = num_buckets
+        self.max_states_in_memory = max_states_in_memory
+        self.spill_dir = spill_dir
+        self.parts = [[] for _ in range(num_buckets)]
+        self.states_in_memory = 0
+        self.spilled = False
+
+    def add(self, states):
+        bucket = ((states[:, 0] ^ (states[:, 1] * HASH_MULTIPLIER)) % U(self.num_buckets)).astype(np.intp)
+        order = np.argsort(bucket, kind="stable")
+        boundaries = np.searchsorted(bucket[order], np.arange(self.num_buckets + 1))
+        for i in range(self.num_buckets):
+            part = states[order[boundaries[i]:boundaries[i + 1]]]
+            if len(part):
+                self.parts[i].append(part)
+        self.states_in_memory += len(states)
+        if self.states_in_memory > self.max_states_in_memory:
+            self.spill()
+
+    def bucket_path(self, i):
+        return os.path.join(self.spill_dir, f"bucket_{i}.bin")
+
+    def spill(self):
+        self.spilled = True
+        for i, parts in enumerate(self.parts):
+            if parts:
+                with open(self.bucket_path(i), "ab") as f:
+                    unique_states(np.concatenate(parts)).tofile(f)
+        self.parts = [[] for _ in range(self.num_buckets)]
+        self.states_in_memory = 0
+
+    def buckets(self):
+        """Yields each bucket deduplicated"""
+        for i, parts in enumerate(self.parts):
+            if self.spilled and os.path.exists(self.bucket_path(i)):
+                parts = parts + [np.fromfile(self.bucket_path(i), dtype=STATE_DTYPE).reshape(-1, 2)]
+                os.remove(self.bucket_path(i))
+            if parts:
+                yield unique_states(np.concatenate(parts))
+
+
+class Frontier:
+    def __init__(self, spill_dir, ply):
+        """States of one ply, kept in memory or saved to one file per bucket"""
+        self.spill_dir = spill_dir
+        self.ply = ply
+        self.arrays = []
+        self.paths = []
+
+    def add(self, states, spill):
+        if spill:
+            path = os.path.join(self.spill_dir, f"ply_{self.ply}_{len(self.paths)}.npy")
+            np.save(path, states)
+            self.paths.append(path)
+        else:
+            self.arrays.append(states)
+
+    def chunks(self, chunk_size):
+        for states in self.arrays:
+            for i in range(0, len(states), chunk_size):
+                yield states[i:i + chunk_size]
+        for path in self.paths:
+            states = np.load(path, mmap_mode="r")
+            for i in range(0, len(states), chunk_size):
+                yield np.array(states[i:i + chunk_size])
+
+    def remove(self):
+        for path in self.paths:
+            os.remove(path)
+
+
+def enumerate_states(args):
+    game = Game.from_serialized(args.load_state) if args.load_state else Game()
+    deal = Deal(game.red_cards, game.blue_cards, game.neutral_card)
+    print("Deal:", "red", " ".join(deal.cards[i].name for i in (0, 1)), "blue",
+          " ".join(deal.cards[i].name for i in (2, 3)), "neutral", deal.cards[4].name,
+          "starting player", "blue" if game.current_player else "red")
+    if args.symmetry and not deal.mirror_symmetric:
+        print("The deal is not closed under mirroring cards, counting without symmetry")
+        args.symmetry = False
+
+    spill_dir = args.spill_dir or tempfile.mkdtemp(prefix="onitama_states_")
+    os.makedirs(spill_dir, exist_ok=True)
+    frontier = Frontier(spill_dir, 0)
+    start = pack(game.current_player, deal.start_arrangement,
+                 np.array([game.bitboard_king[0]], dtype=STATE_DTYPE), np.array([game.bitboard_pawns[0]], dtype=STATE_DTYPE),
+                 np.array([game.bitboard_king[1]], dtype=STATE_DTYPE), np.array([game.bitboard_pawns[1]], dtype=STATE_DTYPE))
+    if args.symmetry:
+        start = canonicalize(start, deal)
+    frontier.add(start, False)
+    total_states, terminal_states = 1, int(terminal_mask(start).sum())
+    print(f"ply 0: {total_states} states, {terminal_states} terminal")
+
+    try:
+        for ply in range(1, args.plies + 1):
+            started = datetime.now()
+            buckets = BucketStore(args.buckets, args.max_states_in_memory, spill_dir)
+            for chunk in frontier.chunks(args.chunk_size):
+                children = expand(chunk, deal)
+                if args.symmetry:
+                    children = canonicalize(children, deal)
+                buckets.add(unique_states(children))
+            frontier.remove()
+
+            frontier = Frontier(spill_dir, ply)
+            total_states = terminal_states = 0
+            for states in buckets.buckets():
+                total_states += len(states)
+                terminal_states += int(terminal_mask(states).sum())
+                frontier.add(states, buckets.spilled)
+            print(f"ply {ply}: {total_states} states, {terminal_states} terminal "
+                  f"({(datetime.now() - started).total_seconds():.1f} s{', spilled to disk' if buckets.spilled else ''})",
+                  flush=True)
+            if total_states == terminal_states:
+                break
+    finally:
+        frontier.remove()
+        if not args.spill_dir:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--load_state", default=None, help="serialized starting position, defaults to a random deal", type=int)
+    parser.add_argument("-p", "--plies", default=8, type=int)
+    parser.add_argument("--symmetry", default=False, action="store_true", help="count mirror-image positions once, if every card's mirror image is in the deal")
+    parser.add_argument("--buckets", default=64, help="hash buckets per ply, each must fit in memory", type=int)
+    parser.add_argument("--max_states_in_memory", default=20000000, help="children held before buckets spill to disk", type=int)
+    parser.add_argument("--chunk_size", default=1000000, help="frontier states expanded at once", type=int)
+    parser.add_argument("--spill_dir", default=None, help="directory for spilled frontiers, defaults to a temporary directory")
+
+    args = parser.parse_args()
+
+    enumerate_states(args)
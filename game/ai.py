@@ -1,112 +1,406 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import random
 
 from . import Game, Move
+from .solver import WIN, ProofNumberSolver
 
 INF = 1000
+# won and lost positions score WIN_SCORE less WIN_PLY_PENALTY for every ply until the game ends, so faster wins
+# and slower losses score better whatever depth they were found at. Evaluations stay well below WIN_THRESHOLD.
+WIN_PLY_PENALTY = 0.01
+WIN_THRESHOLD = Game.WIN_SCORE / 2
+# late move reductions search quiet moves after the first few at reduced depth. This is lossy: a reduced move
+# that fails low is never searched to full depth, so root scores can change.
+LMR_FULL_DEPTH_MOVES = 3
+LMR_MIN_DEPTH = 3
+LMR_REDUCTION = 1
+# null move pruning lets the current player pass and cuts off if the reduced search still fails high
+NULL_MOVE_MIN_DEPTH = 3
+NULL_MOVE_REDUCTION = 2
+# most a quiet move can change each evaluation mode, used for futility pruning
+FUTILITY_MARGINS = {0: 1, 1: 3.5, 2: 2}
+# root moves are searched just below the scores they have to beat, so moves scoring equal to the best
+# still get exact scores and stay in the random choice among them. Smaller than any score difference.
+ROOT_WINDOW_MARGIN = 0.001
+SELECTIVE_SEARCH_OPTIONS = {"lmr": "late_move_reductions", "null": "null_move_pruning", "futility": "futility_pruning"}
+
+def selective_search_options(names):
+    """Maps a comma separated list such as "lmr,null,futility" to OnitamaAI keyword arguments"""
+    options = {}
+    for name in filter(None, (names or "").split(",")):
+        if name not in SELECTIVE_SEARCH_OPTIONS:
+            raise ValueError(f"unknown selective search option {name!r}, expected one of {', '.join(SELECTIVE_SEARCH_OPTIONS)}")
+        options[SELECTIVE_SEARCH_OPTIONS[name]] = True
+    return options
+
+def ply_back(score):
+    """A child's score as seen from its parent, one ply further from the end if the game is decided"""
+    if WIN_THRESHOLD <= score < INF:
+        return round(score - WIN_PLY_PENALTY, 2)
+    if -INF < score <= -WIN_THRESHOLD:
+        return round(score + WIN_PLY_PENALTY, 2)
+    return score
+
+def ply_forward(bound):
+    """A parent's alpha or beta as passed to its children, the inverse of ply_back"""
+    if WIN_THRESHOLD <= bound < INF:
+        return bound + WIN_PLY_PENALTY
+    if -INF < bound <= -WIN_THRESHOLD:
+        return bound - WIN_PLY_PENALTY
+    return bound
+
+# entries in an EvaluationCache unless given a size, each takes roughly 250 bytes
+DEFAULT_EVALUATION_CACHE_SIZE = 1000000
+
+class EvaluationCache:
+    def __init__(self, max_size=DEFAULT_EVALUATION_CACHE_SIZE):
+        """Bounded cache of Game.evaluate scores keyed by the board and evaluation mode only.
+        Evaluations do not depend on the cards or the player to move, so one entry serves every card arrangement.
+        A max_size of None or 0 keeps every entry, like OnitamaAI.max_cache_size."""
+        self.scores = OrderedDict()
+        self.resize(max_size)
+
+    def resize(self, max_size):
+        if max_size is not None and max_size < 0:
+            raise ValueError(f"cache size must not be negative: {max_size}")
+        self.max_size = max_size or None
+        while self.max_size is not None and len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)
+
+    def store(self, key, score):
+        if self.max_size is not None and len(self.scores) >= self.max_size:
+            # evicts the oldest entry in constant time, unlike deleting the first key of a plain dict
+            self.scores.popitem(last=False)
+        self.scores[key] = score
+
+    def evaluate(self, game: Game, mode=0):
+        key = (mode, game.bitboard_king[0], game.bitboard_pawns[0], game.bitboard_king[1], game.bitboard_pawns[1])
+        score = self.scores.get(key)
+        if score is None:
+            score = game.evaluate(mode)
+            self.store(key, score)
+        return score
+
+# shared by every OnitamaAI in the process unless one is given its own, resize it to bound its memory
+SHARED_EVALUATION_CACHE = EvaluationCache()
 
 class OnitamaAI:
-    def __init__(self, game, ai_player=0, evaluation_mode=0):
+    def __init__(self, game, ai_player=0, evaluation_mode=0, max_cache_size=None, threat_detection=True,
+                 late_move_reductions=False, null_move_pruning=False, futility_pruning=False,
+                 evaluation_cache=None, solver_nodes=0):
         self.game = game
         self.ai_player = ai_player * 2 - 1
         self.evaluation_mode = evaluation_mode
         self.state_cache = {}
-    
-    def minimax(self, game: Game, depth, alpha, beta, time_limit=None):
+        # state_cache is cleared before a search if it grows past this many entries
+        self.max_cache_size = max_cache_size
+        # number of positions visited by minimax, for reporting search speed
+        self.nodes = 0
+        # set from another thread to abort the current search as if it ran out of time
+        self.stop_requested = False
+        # use Game.has_winning_move and Game.is_threatened to score wins without searching them,
+        # extend the search past threatened leaves and skip moves that hand the opponent a win
+        self.threat_detection = threat_detection
+        # selective search, each can be switched on separately to measure it in self-play.
+        # Late move reductions trade exact root scores for depth, the other two rarely change them.
+        self.late_move_reductions = late_move_reductions
+        self.null_move_pruning = null_move_pruning
+        self.futility_pruning = futility_pruning
+        self.evaluation_cache = evaluation_cache or SHARED_EVALUATION_CACHE
+        # node budget of the proof-number search for a forced win run before each decision, 0 to skip it
+        self.solver_nodes = solver_nodes
+        self.solver = ProofNumberSolver(max_nodes=solver_nodes)
+
+    def out_of_time(self, time_limit):
+        return self.stop_requested or (time_limit and datetime.now() > time_limit)
+
+    def win_in_one_score(self, game: Game):
+        """Score minimax would give a position where the current player has a winning move"""
+        return (game.current_player * 2 - 1) * ply_back(game.WIN_SCORE)
+
+    def is_quiet(self, game: Game, move: Move):
+        """Whether a move neither captures nor moves the master onto the temple"""
+        end_mask = 1 << move.end
+        opponent = 1 - game.current_player
+        if (game.bitboard_king[opponent] | game.bitboard_pawns[opponent]) & end_mask:
+            return False
+        return not (game.bitboard_king[game.current_player] & (1 << move.start)
+                    and end_mask == game.WIN_BITMASK[game.current_player])
+
+    def ordered_moves(self, game: Game):
+        if not self.late_move_reductions:
+            return game.legal_moves()
+        # late move reductions rely on the forcing moves being searched first
+        return sorted(game.legal_moves(), key=lambda move: self.is_quiet(game, move))
+
+    def null_move_score(self, game: Game, depth, alpha, beta, time_limit, extensions):
+        """Searches the position with the current player passing, at reduced depth.
+        Returns None when passing is not a safe test for this position."""
+        player = game.current_player * 2 - 1
+        if (depth < NULL_MOVE_MIN_DEPTH or game.is_threatened() or not game.bitboard_pawns[game.current_player]
+                or player * (beta if player > 0 else alpha) >= WIN_THRESHOLD):
+            # passing would hide threats, zugzwang with a lone master, or mis-score forced wins
+            return None
+        null_game = game.copy()
+        null_game.current_player = 1 - game.current_player
+        return ply_back(self.minimax(null_game, depth - 1 - NULL_MOVE_REDUCTION, ply_forward(alpha),
+                                     ply_forward(beta), time_limit, extensions, allow_null=False))
+
+    def minimax(self, game: Game, depth, alpha, beta, time_limit=None, extensions=1, allow_null=True):
+        self.nodes += 1
+        if depth <= 0:
+            # callers score positions where the current player has a winning move without calling minimax
+            if self.threat_detection and extensions > 0 and game.is_threatened():
+                # search one more ply so the current player has to answer the threat
+                return self.minimax(game, 1, alpha, beta, time_limit, extensions - 1)
+            # leaves skip the state cache, whose key needs the cards, for the board-only evaluation cache
+            return self.evaluation_cache.evaluate(game, self.evaluation_mode)
         cached = self.state_cache.get((depth, game.serialize()))
         if cached:
             return cached
-        if depth <= 0 or game.determine_winner():
-            evaluation = game.evaluate(self.evaluation_mode)
+        if game.determine_winner():
+            evaluation = self.evaluation_cache.evaluate(game, self.evaluation_mode)
             self.state_cache[depth, game.serialize()] = evaluation
             return evaluation
+        if self.null_move_pruning and allow_null:
+            null_score = self.null_move_score(game, depth, alpha, beta, time_limit, extensions)
+            if null_score is not None and (null_score >= beta if game.current_player > 0 else null_score <= alpha):
+                return null_score
+        futility_limit = None
+        if self.futility_pruning and depth == 1:
+            futility_margin = FUTILITY_MARGINS.get(self.evaluation_mode, FUTILITY_MARGINS[0])
+            player = game.current_player * 2 - 1
+            futility_limit = self.evaluation_cache.evaluate(game, self.evaluation_mode) + player * futility_margin
         if game.current_player > 0:
             best_score = -INF
-            for move in game.legal_moves():
+            losing_score = None
+            for move_count, move in enumerate(self.ordered_moves(game)):
+                quiet = (self.late_move_reductions or futility_limit is not None) and self.is_quiet(game, move)
                 new_game = game.copy()
                 new_game.apply_move(move)
+                winner = new_game.determine_winner()
 
-                game_score = self.minimax(new_game, depth - 1, alpha, beta, time_limit)
+                if self.threat_detection and not winner and new_game.can_win_immediately(new_game.current_player):
+                    # the opponent wins next move, so only fall back to this if every move loses
+                    losing_score = ply_back(self.win_in_one_score(new_game))
+                    continue
+                # quiet moves that threaten a win are searched like forcing moves
+                quiet = quiet and not new_game.can_win_immediately(game.current_player)
 
-                winner = new_game.determine_winner()
-                if winner:
-                    # prioritize moves that end the game faster if blue, and prolong if red
-                    game_score += depth * winner * 0.01
+                if quiet and futility_limit is not None and futility_limit <= alpha:
+                    # a quiet move cannot raise the evaluation past alpha before the horizon
+                    best_score = max(best_score, futility_limit)
+                    continue
+
+                child_alpha, child_beta = ply_forward(alpha), ply_forward(beta)
+                if (quiet and self.late_move_reductions and depth >= LMR_MIN_DEPTH
+                        and move_count >= LMR_FULL_DEPTH_MOVES):
+                    child_score = self.minimax(new_game, depth - 1 - LMR_REDUCTION, child_alpha, child_beta, time_limit,
+                                               extensions)
+                    # only moves that fail low at reduced depth keep the reduced score
+                    reduced = child_score <= child_alpha
+                    if not reduced:
+                        child_score = self.minimax(new_game, depth - 1, child_alpha, child_beta, time_limit, extensions)
+                else:
+                    reduced = False
+                    child_score = self.minimax(new_game, depth - 1, child_alpha, child_beta, time_limit, extensions)
+                game_score = ply_back(child_score)
 
                 best_score = max(best_score, game_score)
                 alpha = max(alpha, best_score)
-                if time_limit and datetime.now() > time_limit:
+                if self.out_of_time(time_limit):
                     break
-                # only save state if we didn't run out of time
-                self.state_cache[depth - 1, new_game.serialize()] = game_score
+                # only save state if we didn't run out of time or reduce the search, leaves are never looked up
+                if not reduced and depth > 1:
+                    self.state_cache[depth - 1, new_game.serialize()] = child_score
                 if beta <= alpha or winner:
                     break
+            if best_score == -INF and losing_score is not None:
+                best_score = losing_score
             return best_score
         else:
             best_score = INF
-            for move in game.legal_moves():
+            losing_score = None
+            for move_count, move in enumerate(self.ordered_moves(game)):
+                quiet = (self.late_move_reductions or futility_limit is not None) and self.is_quiet(game, move)
                 new_game = game.copy()
                 new_game.apply_move(move)
+                winner = new_game.determine_winner()
 
-                game_score = self.minimax(new_game, depth - 1, alpha, beta, time_limit)
+                if self.threat_detection and not winner and new_game.can_win_immediately(new_game.current_player):
+                    # the opponent wins next move, so only fall back to this if every move loses
+                    losing_score = ply_back(self.win_in_one_score(new_game))
+                    continue
+                # quiet moves that threaten a win are searched like forcing moves
+                quiet = quiet and not new_game.can_win_immediately(game.current_player)
 
-                winner = new_game.determine_winner()
-                if winner:
-                    # prioritize moves that end the game faster if blue, and prolong if red
-                    game_score -= depth * winner * 0.01
+                if quiet and futility_limit is not None and futility_limit >= beta:
+                    # a quiet move cannot lower the evaluation past beta before the horizon
+                    best_score = min(best_score, futility_limit)
+                    continue
+
+                child_alpha, child_beta = ply_forward(alpha), ply_forward(beta)
+                if (quiet and self.late_move_reductions and depth >= LMR_MIN_DEPTH
+                        and move_count >= LMR_FULL_DEPTH_MOVES):
+                    child_score = self.minimax(new_game, depth - 1 - LMR_REDUCTION, child_alpha, child_beta, time_limit,
+                                               extensions)
+                    # only moves that fail high at reduced depth keep the reduced score
+                    reduced = child_score >= child_beta
+                    if not reduced:
+                        child_score = self.minimax(new_game, depth - 1, child_alpha, child_beta, time_limit, extensions)
+                else:
+                    reduced = False
+                    child_score = self.minimax(new_game, depth - 1, child_alpha, child_beta, time_limit, extensions)
+                game_score = ply_back(child_score)
 
                 best_score = min(best_score, game_score)
                 beta = min(beta, best_score)
-                if time_limit and datetime.now() > time_limit:
+                if self.out_of_time(time_limit):
                     break
-                # only save state if we didn't run out of time
-                self.state_cache[depth - 1, new_game.serialize()] = game_score
+                # only save state if we didn't run out of time or reduce the search, leaves are never looked up
+                if not reduced and depth > 1:
+                    self.state_cache[depth - 1, new_game.serialize()] = child_score
                 if beta <= alpha or winner:
                     break
+            if best_score == INF and losing_score is not None:
+                best_score = losing_score
             return best_score
     
-    def evaluate_moves(self, depth_limit, think_time):
+    def evaluate_moves(self, depth_limit, think_time, info_callback=None, multipv=1):
+        """Returns {serialized move: [score, depth, exact]} for every legal move.
+        Root moves share one alpha-beta window, so only the best multipv moves are sure to have exact scores.
+        The other moves hold a bound showing they are worse than those.
+        info_callback(depth, moves) is called after each completed iteration of the search."""
         time_limit = datetime.now() + timedelta(milliseconds=think_time)
-        current_player = self.game.current_player * 2 - 1
         moves = {}
-        
+        if self.max_cache_size and len(self.state_cache) > self.max_cache_size:
+            self.state_cache.clear()
+        player = self.game.current_player * 2 - 1
+        legal_moves = list(self.game.legal_moves())
+
         # Perform iterative deepening search
         depth = 0
-        while datetime.now() < time_limit and depth < depth_limit:
+        while not self.out_of_time(time_limit) and depth < depth_limit:
             depth += 1
-            for move in self.game.legal_moves():
+            # search the best moves of the previous iteration first so the window narrows early
+            legal_moves.sort(key=lambda move: -player * moves.get(move.serialize(), [0])[0])
+            # exact scores found at this depth, best first
+            exact_scores = []
+            for move in legal_moves:
                 new_game = self.game.copy()
                 new_game.apply_move(move)
 
-                game_score = self.minimax(new_game, depth, -INF, INF, time_limit)
+                if self.threat_detection and new_game.has_winning_move():
+                    child_score = self.win_in_one_score(new_game)
+                    exact = True
+                else:
+                    alpha, beta = -INF, INF
+                    if len(exact_scores) >= multipv:
+                        # this move only needs an exact score if it beats the current multipv-th best
+                        if player > 0:
+                            alpha = exact_scores[multipv - 1] - ROOT_WINDOW_MARGIN
+                        else:
+                            beta = exact_scores[multipv - 1] + ROOT_WINDOW_MARGIN
+                    alpha, beta = ply_forward(alpha), ply_forward(beta)
+                    child_score = self.minimax(new_game, depth, alpha, beta, time_limit)
+                    exact = alpha < child_score < beta
+                game_score = ply_back(child_score)
 
-                if datetime.now() > time_limit:
+                if self.out_of_time(time_limit):
                     break
-                # only save state if we didn't run out of time
-                self.state_cache[depth, new_game.serialize()] = game_score
+                if exact:
+                    # only save state if we didn't run out of time and the score is not a bound
+                    self.state_cache[depth, new_game.serialize()] = child_score
+                    exact_scores.append(game_score)
+                    exact_scores.sort(key=lambda score: -player * score)
 
                 # Override previous evaluations of this move as we search deeper
-                moves[move.serialize()] = [game_score, depth]
+                moves[move.serialize()] = [game_score, depth, exact]
+            else:
+                if info_callback:
+                    info_callback(depth, moves)
+                # won and lost scores are final, so a lost position would otherwise deepen up to depth_limit
+                if all(abs(score) >= WIN_THRESHOLD if exact else player * score <= -WIN_THRESHOLD
+                       for score, _, exact in moves.values()):
+                    break
 
         return moves
-    
-    def decide_move(self, depth_limit=1000, think_time=500, verbose=False):
-        moves = self.evaluate_moves(depth_limit, think_time)
+
+    def principal_variation(self, move: Move, depth):
+        """Reconstructs the expected line of play starting with a root move searched to depth
+        by following the best cached scores"""
+        line = [move]
+        game = self.game.copy()
+        game.apply_move(move)
+        while depth > 0 and not game.determine_winner():
+            depth -= 1
+            player = game.current_player * 2 - 1
+            best = None
+            for child_move in game.legal_moves():
+                child = game.copy()
+                child.apply_move(child_move)
+                if depth > 0:
+                    score = self.state_cache.get((depth, child.serialize()))
+                elif self.threat_detection and child.has_winning_move():
+                    # minimax does not play moves that hand the opponent a win
+                    continue
+                else:
+                    # leaves skip the state cache, so the last move is picked by the leaf evaluation minimax uses
+                    score = self.evaluation_cache.evaluate(child, self.evaluation_mode)
+                if score is None:
+                    continue
+                if best is None or player * score > player * best[0]:
+                    best = (score, child_move, child)
+            if best is None:
+                break
+            line.append(best[1])
+            game = best[2]
+        return line
+
+    def best_move(self, moves):
+        """Picks randomly among the best scoring moves returned by evaluate_moves"""
         current_player = self.game.current_player * 2 - 1
         best_moves = []
         best_score = -INF * current_player
-        for serialized_move, (game_score, depth) in moves.items():
+        # bounds are never better than the best exact score of their iteration
+        exact_moves = {move: entry for move, entry in moves.items() if entry[2]} or moves
+        for serialized_move, (game_score, depth, _) in exact_moves.items():
             if current_player * game_score > current_player * best_score:
                 best_score = game_score
                 best_moves = [serialized_move]
             elif game_score == best_score:
                 best_moves.append(serialized_move)
-
-        if verbose:
-            for serialized_move in sorted(moves, key=lambda move: moves[move][0], reverse=self.game.current_player):
-                move = Move.from_serialized(serialized_move)
-                new_game = self.game.copy()
-                new_game.apply_move(move)
-                print(f"Move {move} evaluation {moves[serialized_move][0]} at depth {moves[serialized_move][1]} (new_game {new_game.serialize()})")
         ai_move = random.choice(best_moves)
         return Move.from_serialized(ai_move), best_score, moves[ai_move][1]
+
+    def ranked_moves(self, moves, count=None):
+        """Moves with exact scores from evaluate_moves as (move, score, depth), best first"""
+        current_player = self.game.current_player * 2 - 1
+        ranked = sorted(((Move.from_serialized(serialized_move), game_score, depth)
+                         for serialized_move, (game_score, depth, exact) in moves.items() if exact),
+                        key=lambda entry: -current_player * entry[1])
+        return ranked[:count]
+
+    def print_moves(self, moves):
+        # bounds are an upper limit on blue's score, or a lower limit on red's
+        bound = "<= " if self.game.current_player > 0 else ">= "
+        for serialized_move in sorted(moves, key=lambda move: moves[move][0], reverse=self.game.current_player):
+            move = Move.from_serialized(serialized_move)
+            new_game = self.game.copy()
+            new_game.apply_move(move)
+            game_score, depth, exact = moves[serialized_move]
+            print(f"Move {move} evaluation {'' if exact else bound}{game_score} at depth {depth} (new_game {new_game.serialize()})")
+
+    def decide_move(self, depth_limit=1000, think_time=500, verbose=False, multipv=1):
+        if self.solver_nodes:
+            result = self.solver.solve(self.game, check_loss=False)
+            if result.outcome == WIN and result.line:
+                if verbose:
+                    print("Forced win:", " ".join(map(str, result.line)), f"({result.nodes} nodes)")
+                score = round(Game.WIN_SCORE - WIN_PLY_PENALTY * len(result.line), 2)
+                return result.line[0], (self.game.current_player * 2 - 1) * score, len(result.line)
+        moves = self.evaluate_moves(depth_limit, think_time, multipv=multipv)
+        if verbose:
+            self.print_moves(moves)
+        return self.best_move(moves)
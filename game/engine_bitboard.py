@@ -55,6 +55,8 @@ class Card:
                     if new_x in range(BOARD_WIDTH) and new_y in range(BOARD_HEIGHT):
                         board |= 1 << dest.to_index()
                 self.move_table[player_index][point_index] = board
+        # plain int copy, which is much faster to index than the numpy array for single lookups
+        self.move_table_list = self.move_table.tolist()
 
     def visualize(self, reverse=False):
         # Cards are displayed with board centre (2, 2) at (0, 0)
@@ -144,15 +146,15 @@ class Game:
         or neutral_card. If starting_player is not specified, uses neutral_card.starting_player."""
         if not (red_cards and blue_cards and neutral_card):
             cards = set(ONITAMA_CARDS)
-            card1, card2 = random.sample(cards, k=2)
+            card1, card2 = random.sample(sorted(cards), k=2)
             red_cards = [ONITAMA_CARDS.get(card1), ONITAMA_CARDS.get(card2)]
             cards -= {card1, card2}
 
-            card1, card2 = random.sample(cards, k=2)
+            card1, card2 = random.sample(sorted(cards), k=2)
             blue_cards = [ONITAMA_CARDS.get(card1), ONITAMA_CARDS.get(card2)]
             cards -= {card1, card2}
 
-            card = random.sample(cards, k=1)[0]
+            card = random.sample(sorted(cards), k=1)[0]
             neutral_card = ONITAMA_CARDS.get(card)
             cards.remove(card)
         if starting_player is None:
@@ -288,6 +290,22 @@ class Game:
                    starting_player=starting_player,
                    bitboard_king=bitboard_king, bitboard_pawns=bitboard_pawns)
 
+    def validate(self):
+        """Raises ValueError if this is not a real position, such as one decoded from a bad serialized value"""
+        if self.current_player not in (0, 1):
+            raise ValueError(f"invalid current player {self.current_player}")
+        cards = self.red_cards + self.blue_cards + [self.neutral_card]
+        if None in cards or len({card.name for card in cards}) != len(cards):
+            raise ValueError("invalid cards")
+        boards = self.bitboard_king + self.bitboard_pawns
+        occupied = 0
+        for board in boards:
+            if board >> (BOARD_WIDTH * BOARD_HEIGHT) or board & occupied:
+                raise ValueError("overlapping pieces")
+            occupied |= board
+        if any(count_bits(king) > 1 for king in self.bitboard_king):
+            raise ValueError("more than one master")
+
     def legal_moves(self):
         # adapted from https://github.com/maxbennedich/onitama/blob/master/src/main/java/onitama/ai/MoveGenerator.java
         cards = self.red_cards if self.current_player == 0 else self.blue_cards
@@ -360,6 +378,32 @@ class Game:
         self.neutral_card, cards[card_idx] = cards[card_idx], self.neutral_card
         self.current_player = 1 - self.current_player
     
+    def can_win_immediately(self, player):
+        """Whether player could capture the opponent master or reach the temple with one move of their cards"""
+        king = self.bitboard_king[player]
+        opponent_king = self.bitboard_king[1 - player]
+        if not king or not opponent_king:
+            return False
+        cards = self.red_cards if player == 0 else self.blue_cards
+        own_pieces = king | self.bitboard_pawns[player]
+        king_pos = king.bit_length() - 1
+        opponent_king_pos = opponent_king.bit_length() - 1
+        for card in cards:
+            # the other player's table holds the inverse moves, so it gives the squares attacking the opponent master
+            if card.move_table_list[1 - player][opponent_king_pos] & own_pieces:
+                return True
+            if card.move_table_list[player][king_pos] & self.WIN_BITMASK[player] & ~own_pieces:
+                return True
+        return False
+
+    def has_winning_move(self):
+        """Whether the current player can win this move. Always False once the game is over."""
+        return not self.determine_winner() and self.can_win_immediately(self.current_player)
+
+    def is_threatened(self):
+        """Whether the opponent of the current player could win on their next move if the board stayed the same"""
+        return not self.determine_winner() and self.can_win_immediately(1 - self.current_player)
+
     def determine_winner(self):
         """Returns -1 for red win, 1 for blue win, 0 for no win"""
         for i in range(2):
@@ -0,0 +1,171 @@
+"""Compact binary game records.
+
+A record file starts with FILE_HEADER followed by one record per game:
+    GAME_HEADER: starting position as a 16 byte little-endian Game.serialize() value (which holds the card deal
+                 and starting player), red and blue settings (evaluation mode, or HUMAN), red and blue
+                 selective search options (SELECTIVE_FLAGS), flags, result (-1 red win, 1 blue win,
+                 0 unfinished), think time in ms, depth limit (0 if none), solver node budget and the
+                 number of moves
+    moves:       one little-endian uint16 Move.serialize() value per move, or MOVE_STATS_DTYPE entries
+                 (move, score, depth, nodes) if FLAG_STATS is set. Moves without stats have a NaN score.
+"""
+import mmap
+import struct
+from typing import Optional
+
+import numpy as np
+
+from .engine_bitboard import Game, Move
+
+FILE_MAGIC = b"ONIR"
+FILE_VERSION = 2
+FILE_HEADER = struct.Struct("<4sB3x")
+GAME_HEADER = struct.Struct("<16sBBBBBbIHIH")
+HUMAN = 255
+FLAG_STATS = 1
+# bits of the selective search options, named as in game.ai.selective_search_options
+SELECTIVE_FLAGS = {"lmr": 1, "null": 2, "futility": 4}
+
+MOVE_DTYPE = np.dtype("<u2")
+MOVE_STATS_DTYPE = np.dtype([("move", "<u2"), ("score", "<f4"), ("depth", "<u2"), ("nodes", "<u4")])
+
+
+def selective_flags(names):
+    """Packs a comma separated list of selective search options such as "lmr,null" into SELECTIVE_FLAGS bits"""
+    return sum(SELECTIVE_FLAGS[name] for name in set(filter(None, (names or "").split(","))))
+
+
+def selective_names(flags):
+    """The comma separated selective search options packed by selective_flags"""
+    return ",".join(name for name, flag in SELECTIVE_FLAGS.items() if flags & flag)
+
+
+class GameRecordWriter:
+    def __init__(self, path):
+        """Appends games to a record file, creating it if needed. Several writers may share a file."""
+        try:
+            # only the writer that creates the file writes its header, straight away
+            with open(path, "xb") as f:
+                f.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        except FileExistsError:
+            with open(path, "rb") as f:
+                header = f.read(FILE_HEADER.size)
+            # empty while the writer that created it has not written the header yet
+            if header and header != FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION):
+                raise ValueError(f"not a version {FILE_VERSION} game record file: {path}")
+        self.file = open(path, "ab")
+        self.start_position = None
+
+    def start_game(self, game: Game, red_player=HUMAN, blue_player=HUMAN, time_limit_ms=0, depth_limit=0,
+                   solver_nodes=0, red_selective="", blue_selective=""):
+        """red_player and blue_player are AI evaluation modes, or HUMAN. red_selective and blue_selective are
+        selective search options as taken by game.ai.selective_search_options."""
+        self.start_position = game.serialize()
+        self.settings = (red_player, blue_player, selective_flags(red_selective), selective_flags(blue_selective),
+                         time_limit_ms, min(depth_limit, 0xFFFF), solver_nodes)
+        self.moves = []
+        self.has_stats = False
+
+    def record_move(self, move: Move, score=None, depth=None, nodes=None):
+        if score is not None:
+            self.has_stats = True
+        # depth fits the field even if iterative deepening ran up to a huge depth limit
+        self.moves.append((move.serialize(), float("nan") if score is None else score, min(depth or 0, 0xFFFF),
+                           nodes or 0))
+
+    def end_game(self, winner=0):
+        """Writes the current game with winner -1 for red, 1 for blue or 0 if unfinished"""
+        if self.start_position is None:
+            return
+        red_player, blue_player, red_selective, blue_selective, time_limit_ms, depth_limit, solver_nodes = self.settings
+        header = GAME_HEADER.pack(self.start_position.to_bytes(16, "little"), red_player, blue_player,
+                                  red_selective, blue_selective, FLAG_STATS if self.has_stats else 0, winner,
+                                  time_limit_ms, depth_limit, solver_nodes, len(self.moves))
+        if self.has_stats:
+            moves = np.array(self.moves, dtype=MOVE_STATS_DTYPE)
+        else:
+            moves = np.array([move for move, *_ in self.moves], dtype=MOVE_DTYPE)
+        # one write per game so records from writers appending to the same file do not interleave
+        self.file.write(header + moves.tobytes())
+        self.file.flush()
+        self.start_position = None
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GameRecord:
+    def __init__(self, buffer, offset):
+        """A game inside a record file buffer. Moves are only decoded when accessed."""
+        (start_position, self.red_player, self.blue_player, red_selective, blue_selective, flags, self.winner,
+         self.time_limit_ms, self.depth_limit, self.solver_nodes, self.num_moves) = GAME_HEADER.unpack_from(buffer, offset)
+        self.start_position = int.from_bytes(start_position, "little")
+        self.red_selective = selective_names(red_selective)
+        self.blue_selective = selective_names(blue_selective)
+        self.has_stats = bool(flags & FLAG_STATS)
+        self.buffer = buffer
+        self.moves_offset = offset + GAME_HEADER.size
+
+    @property
+    def size(self):
+        """Number of bytes taken by this record"""
+        dtype = MOVE_STATS_DTYPE if self.has_stats else MOVE_DTYPE
+        return GAME_HEADER.size + self.num_moves * dtype.itemsize
+
+    def move_array(self):
+        """Zero-copy view of the moves, as MOVE_STATS_DTYPE entries if the record has stats.
+        The reader cannot be closed while such views are alive."""
+        dtype = MOVE_STATS_DTYPE if self.has_stats else MOVE_DTYPE
+        return np.frombuffer(self.buffer, dtype=dtype, count=self.num_moves, offset=self.moves_offset)
+
+    def moves(self):
+        moves = self.move_array()
+        if self.has_stats:
+            moves = moves["move"]
+        for move in moves:
+            yield Move.from_serialized(int(move))
+
+    def initial_game(self):
+        return Game.from_serialized(self.start_position)
+
+    def replay(self, ply: Optional[int] = None):
+        """Returns the game after the first ply moves, or after all moves if ply is None"""
+        game = self.initial_game()
+        for i, move in enumerate(self.moves()):
+            if ply is not None and i >= ply:
+                break
+            game.apply_move(move)
+        return game
+
+
+class GameRecordReader:
+    def __init__(self, path):
+        """Memory-maps a record file so games can be scanned without reading it all"""
+        self.file = open(path, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = FILE_HEADER.unpack_from(self.buffer, 0)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError(f"not a version {FILE_VERSION} game record file: {path}")
+
+    def __iter__(self):
+        offset = FILE_HEADER.size
+        while offset < len(self.buffer):
+            record = GameRecord(self.buffer, offset)
+            yield record
+            offset += record.size
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,161 @@
+"""Proof-number search for forced wins.
+
+Alpha-beta only scores a forced win as WIN_SCORE less a small penalty per ply, and has to search every move to the
+full depth to find it. ProofNumberSolver grows the game tree best-first towards the positions that are cheapest
+to prove or disprove a win for one player (the attacker), and answers win, loss or unknown once the node budget
+runs out. Games can repeat positions forever, so the tree stops at max_plies and a disproof only means there is
+no forced win within that many plies.
+"""
+from collections import OrderedDict
+from typing import List, NamedTuple
+
+from .engine_bitboard import Game, Move
+
+PROOF_INF = 10 ** 9
+DEFAULT_MAX_NODES = 100000
+DEFAULT_MAX_PLIES = 40
+
+WIN = "win"
+LOSS = "loss"
+UNKNOWN = "unknown"
+
+
+class SolveResult(NamedTuple):
+    # WIN or LOSS for the player to move, or UNKNOWN
+    outcome: str
+    # moves from the solved position to the end of the game, empty if UNKNOWN
+    line: List[Move]
+    nodes: int
+
+
+class ProofNode:
+    def __init__(self, game: Game, move, parent, attacker_to_move, remaining_plies):
+        self.game = game
+        self.move = move
+        self.parent = parent
+        self.attacker_to_move = attacker_to_move
+        self.remaining_plies = remaining_plies
+        # None until expanded
+        self.children = None
+        # number of leaves that must be proven to prove (or disproven to disprove) the attacker wins from here
+        self.proof = 1
+        self.disproof = 1
+
+
+class ProofNumberSolver:
+    def __init__(self, max_nodes=DEFAULT_MAX_NODES, max_plies=DEFAULT_MAX_PLIES, max_table_size=1000000):
+        self.max_nodes = max_nodes
+        self.max_plies = max_plies
+        self.max_table_size = max_table_size
+        # (serialized position, attacker, remaining plies) -> whether the attacker wins, kept between solves
+        self.table = OrderedDict()
+
+    def solve(self, game: Game, check_loss=True):
+        """Looks for a forced win for the player to move and, if check_loss is set and none is found,
+        for their opponent. Each side gets its own node budget."""
+        proven, line, nodes = self.prove(game, game.current_player)
+        if proven:
+            return SolveResult(WIN, line, nodes)
+        if check_loss:
+            proven, line, opponent_nodes = self.prove(game, 1 - game.current_player)
+            nodes += opponent_nodes
+            if proven:
+                return SolveResult(LOSS, line, nodes)
+        return SolveResult(UNKNOWN, [], nodes)
+
+    def prove(self, game: Game, attacker, max_plies=None):
+        """Returns (True, winning line, nodes) if attacker has a forced win, (False, [], nodes) if it was
+        disproven within max_plies and (None, [], nodes) if the node budget ran out first"""
+        root = ProofNode(game.copy(), None, None, game.current_player == attacker, max_plies or self.max_plies)
+        # the root skips the table so a position solved before still gets its line
+        self.set_leaf_numbers(root, attacker, use_table=False)
+        nodes = 1
+        while root.proof and root.disproof and nodes < self.max_nodes:
+            node = root
+            # the most proving node: the cheapest child to prove under the attacker, to disprove under the defender
+            while node.children is not None:
+                if node.attacker_to_move:
+                    node = min(node.children, key=lambda child: child.proof)
+                else:
+                    node = min(node.children, key=lambda child: child.disproof)
+            nodes += self.expand(node, attacker)
+            self.update_ancestors(node, attacker)
+
+        if not root.proof:
+            return True, self.winning_line(root, attacker), nodes
+        if not root.disproof:
+            return False, [], nodes
+        return None, [], nodes
+
+    def set_leaf_numbers(self, node: ProofNode, attacker, use_table=True):
+        game = node.game
+        winner = game.determine_winner()
+        if winner:
+            won = winner == attacker * 2 - 1
+        elif game.has_winning_move():
+            won = game.current_player == attacker
+        elif node.remaining_plies <= 0:
+            won = False
+        elif not use_table:
+            return
+        else:
+            won = self.table.get((game.serialize(), attacker, node.remaining_plies))
+            if won is None:
+                return
+        node.proof, node.disproof = (0, PROOF_INF) if won else (PROOF_INF, 0)
+
+    def expand(self, node: ProofNode, attacker):
+        node.children = []
+        for move in node.game.legal_moves():
+            child_game = node.game.copy()
+            child_game.apply_move(move)
+            child = ProofNode(child_game, move, node, not node.attacker_to_move, node.remaining_plies - 1)
+            self.set_leaf_numbers(child, attacker)
+            node.children.append(child)
+        return len(node.children)
+
+    def update_ancestors(self, node: ProofNode, attacker):
+        while node is not None:
+            if node.attacker_to_move:
+                proof = min(child.proof for child in node.children)
+                disproof = min(sum(child.disproof for child in node.children), PROOF_INF)
+            else:
+                proof = min(sum(child.proof for child in node.children), PROOF_INF)
+                disproof = min(child.disproof for child in node.children)
+            node.proof, node.disproof = proof, disproof
+            if not proof or not disproof:
+                self.store(node, attacker, not proof)
+                # only the proof of a win is needed for its line, so resolved subtrees are freed
+                if disproof:
+                    node.children = [child for child in node.children if not child.proof][:1] \
+                        if node.attacker_to_move else node.children
+                else:
+                    node.children = []
+            node = node.parent
+
+    def store(self, node: ProofNode, attacker, won):
+        if len(self.table) >= self.max_table_size:
+            self.table.popitem(last=False)
+        self.table[node.game.serialize(), attacker, node.remaining_plies] = won
+
+    def winning_line(self, root: ProofNode, attacker):
+        line = []
+        node = root
+        while node.children:
+            node = next(child for child in node.children if not child.proof)
+            line.append(node.move)
+        game = node.game
+        if game.determine_winner():
+            return line
+        if game.has_winning_move():
+            # has_winning_move proved this position without a child for the winning move
+            for move in game.legal_moves():
+                child = game.copy()
+                child.apply_move(move)
+                if child.determine_winner():
+                    line.append(move)
+                    break
+        else:
+            # proven in an earlier solve, so searching it again mostly hits the table
+            line.extend(self.prove(game, attacker, node.remaining_plies)[1])
+        return line
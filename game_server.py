@@ -0,0 +1,353 @@
+"""Asyncio HTTP/JSON server hosting many human vs AI games in one process.
+AI searches run on a bounded process pool so slow searches never block other sessions.
+
+    POST   /games              {"serialized": int, "human": 0 or 1, "think_time_ms": int, "evaluation": int}
+                               all fields optional, starts a game with a random deal unless serialized is given
+    GET    /games/<id>         current state of a game
+    POST   /games/<id>/moves   {"move": "tiger c1 c3" or a Move.serialize() value, "wait": bool}
+                               plays the human move and starts the AI reply, waiting for it if wait is set
+    POST   /games/<id>/search  starts the AI move again after a search failed, the game's search_error says why
+    DELETE /games/<id>         ends a game and cancels its search
+
+Games nobody has touched for --session_timeout seconds are ended the same way.
+
+    python3 game_server.py --port 8486 -j 4
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from game import Game, Move, OnitamaAI, Point
+from game.ai import SHARED_EVALUATION_CACHE, selective_search_options
+
+# search caches kept by each worker process, least recently used session first
+_session_caches = OrderedDict()
+_max_cache_entries = 0
+
+
+def init_worker(max_cache_entries):
+    global _max_cache_entries
+    _max_cache_entries = max_cache_entries
+    # the evaluation cache, shared by the worker's sessions, gets the same cap as their state caches
+    SHARED_EVALUATION_CACHE.resize(max_cache_entries)
+
+
+def search(session_id, serialized, think_time, evaluation, selective):
+    """Runs in a worker process. Returns (serialized move, score, depth)."""
+    cache = _session_caches.pop(session_id, None)
+    if cache is None:
+        cache = {}
+    _session_caches[session_id] = cache
+
+    game = Game.from_serialized(serialized)
+    ai = OnitamaAI(game, game.current_player, evaluation, **selective_search_options(selective))
+    ai.state_cache = cache
+    move, score, depth = ai.decide_move(think_time=think_time)
+
+    # keep the caches of this worker's sessions within its share of the memory cap
+    total = sum(map(len, _session_caches.values()))
+    while total > _max_cache_entries and len(_session_caches) > 1:
+        _, evicted = _session_caches.popitem(last=False)
+        total -= len(evicted)
+    if total > _max_cache_entries:
+        cache.clear()
+    return move.serialize(), score, depth
+
+
+class Session:
+    def __init__(self, session_id, game, human, think_time, evaluation):
+        self.id = session_id
+        self.game = game
+        self.human = human
+        self.think_time = think_time
+        self.evaluation = evaluation
+        self.search_task = None
+        # why the last AI search failed, None once a search is started again
+        self.search_error = None
+        self.last_ai_move = None
+        self.last_active = time.monotonic()
+
+    def state(self):
+        winner = self.game.determine_winner()
+        if winner:
+            status = "finished"
+        elif self.search_task is not None:
+            status = "thinking"
+        elif self.search_error is not None:
+            status = "error"
+        else:
+            status = "waiting"
+        return {
+            "id": self.id,
+            "status": status,
+            "winner": winner,
+            "serialized": self.game.serialize(),
+            "current_player": self.game.current_player,
+            "human": self.human,
+            "board": self.game.visualize_board(),
+            "red_cards": [card.name for card in self.game.red_cards],
+            "blue_cards": [card.name for card in self.game.blue_cards],
+            "neutral_card": self.game.neutral_card.name,
+            "last_ai_move": self.last_ai_move,
+            "search_error": self.search_error,
+            "legal_moves": [] if winner or self.game.current_player != self.human
+                           else [{"move": move.serialize(), "name": str(move)} for move in self.game.legal_moves()],
+        }
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def int_field(body, name, default):
+    value = body.get(name, default)
+    # bools are ints in Python but never a sensible value here
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise HTTPError(400, f"{name} must be an integer")
+    return value
+
+
+class GameServer:
+    def __init__(self, args):
+        self.args = args
+        self.executor = ProcessPoolExecutor(args.jobs, initializer=init_worker,
+                                            initargs=(max(args.cache_entries // args.jobs, 1),))
+        # searches waiting for or running on the pool, including cancelled ones still running
+        self.pending_searches = 0
+        self.sessions = {}
+        self.session_ids = itertools.count(1)
+
+    def parse_move(self, game, value):
+        legal_moves = list(game.legal_moves())
+        if isinstance(value, int) and not isinstance(value, bool):
+            try:
+                move = Move.from_serialized(value)
+            except (KeyError, ValueError):
+                raise HTTPError(400, f"invalid move {value!r}")
+        elif not isinstance(value, str):
+            raise HTTPError(400, "move must be a string or an integer")
+        else:
+            try:
+                card, start, end = str(value).split(" ")
+                move = Move(Point.from_algebraic_notation(start).to_index(),
+                            Point.from_algebraic_notation(end).to_index(), card)
+            except (ValueError, IndexError):
+                raise HTTPError(400, f"invalid move {value!r}")
+        if move not in legal_moves:
+            raise HTTPError(400, f"illegal move {value!r}")
+        return move
+
+    def check_search_capacity(self):
+        if self.pending_searches >= self.args.max_queued:
+            raise HTTPError(503, "too many searches queued")
+
+    def start_search(self, session):
+        self.check_search_capacity()
+        self.pending_searches += 1
+        session.search_error = None
+        session.search_task = asyncio.ensure_future(self.ai_move(session))
+
+    def search_finished(self):
+        self.pending_searches -= 1
+
+    async def ai_move(self, session):
+        loop = asyncio.get_running_loop()
+        future = None
+        try:
+            future = self.executor.submit(search, session.id, session.game.serialize(), session.think_time,
+                                          session.evaluation, self.args.selective)
+            # cancelling this task cannot stop a search that has started, so it counts until its worker is free
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.search_finished))
+            serialized_move, _, _ = await asyncio.wrap_future(future)
+        except Exception as e:
+            if future is None:
+                self.search_finished()
+            # the AI is still to move, so the game reports the error until POST /games/<id>/search retries
+            session.search_error = f"{type(e).__name__}: {e}"
+            return
+        finally:
+            session.search_task = None
+        move = Move.from_serialized(serialized_move)
+        session.game.apply_move(move)
+        session.last_ai_move = {"move": serialized_move, "name": str(move)}
+        # the human's idle time starts from the AI's reply
+        session.last_active = time.monotonic()
+
+    async def create_game(self, body):
+        if body.get("serialized") is not None:
+            try:
+                game = Game.from_serialized(int_field(body, "serialized", None))
+                game.validate()
+            except (ValueError, IndexError, KeyError):
+                raise HTTPError(400, "invalid serialized position")
+        else:
+            game = Game()
+        human = int_field(body, "human", 1)
+        if human not in (0, 1):
+            raise HTTPError(400, "human must be 0 or 1")
+        think_time = int_field(body, "think_time_ms", self.args.time_limit_ms)
+        if think_time <= 0:
+            raise HTTPError(400, "think_time_ms must be positive")
+        think_time = min(think_time, self.args.max_time_limit_ms)
+        evaluation = int_field(body, "evaluation", 0)
+        if evaluation not in (0, 1, 2):
+            raise HTTPError(400, "evaluation must be 0, 1 or 2")
+        session = Session(next(self.session_ids), game, human, think_time, evaluation)
+        if game.current_player != human and not game.determine_winner():
+            self.start_search(session)
+        self.sessions[session.id] = session
+        return 201, session.state()
+
+    async def play_move(self, session, body):
+        if session.search_task is not None or session.game.current_player != session.human:
+            raise HTTPError(409, "not the human's turn")
+        if session.game.determine_winner():
+            raise HTTPError(409, "game is finished")
+        move = self.parse_move(session.game, body.get("move"))
+        wait = body.get("wait", False)
+        if not isinstance(wait, bool):
+            raise HTTPError(400, "wait must be true or false")
+        # refuse before the move is played, otherwise the game would be left waiting on a search that never runs
+        self.check_search_capacity()
+        session.game.apply_move(move)
+        if not session.game.determine_winner():
+            self.start_search(session)
+            if wait:
+                await asyncio.shield(session.search_task)
+        return 200, session.state()
+
+    def retry_search(self, session):
+        if (session.search_task is not None or session.game.current_player == session.human
+                or session.game.determine_winner()):
+            raise HTTPError(409, "the AI is not waiting to move")
+        self.start_search(session)
+        return 200, session.state()
+
+    def delete_game(self, session):
+        if session.search_task is not None:
+            # a search still queued is dropped from the pool, a running one finishes and is discarded
+            session.search_task.cancel()
+        del self.sessions[session.id]
+        return 200, {"id": session.id, "status": "deleted"}
+
+    async def route(self, method, path, body):
+        parts = [part for part in path.split("/") if part]
+        if parts == ["games"]:
+            if method == "POST":
+                return await self.create_game(body)
+            if method == "GET":
+                return 200, {"games": [session.state() for session in self.sessions.values()]}
+            raise HTTPError(405, "method not allowed")
+        if len(parts) in (2, 3) and parts[0] == "games":
+            try:
+                session = self.sessions[int(parts[1])]
+            except (ValueError, KeyError):
+                raise HTTPError(404, "no such game")
+            session.last_active = time.monotonic()
+            if len(parts) == 3 and parts[2] == "moves" and method == "POST":
+                return await self.play_move(session, body)
+            if len(parts) == 3 and parts[2] == "search" and method == "POST":
+                return self.retry_search(session)
+            if len(parts) == 2 and method == "GET":
+                return 200, session.state()
+            if len(parts) == 2 and method == "DELETE":
+                return self.delete_game(session)
+            raise HTTPError(405, "method not allowed")
+        raise HTTPError(404, "not found")
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            content_length = int(headers.get("content-length", 0))
+            raw_body = await reader.readexactly(content_length) if content_length else b""
+
+            try:
+                if len(request_line) < 2:
+                    raise HTTPError(400, "bad request line")
+                try:
+                    body = json.loads(raw_body) if raw_body else {}
+                except ValueError:
+                    raise HTTPError(400, "body is not JSON")
+                if not isinstance(body, dict):
+                    raise HTTPError(400, "body must be a JSON object")
+                status, response = await self.route(request_line[0], request_line[1], body)
+            except HTTPError as e:
+                status, response = e.status, {"error": str(e)}
+            except asyncio.CancelledError:
+                status, response = 409, {"error": "search was cancelled"}
+            except Exception as e:
+                # a bug in one request should still get an answer rather than a dropped connection
+                status, response = 500, {"error": f"{type(e).__name__}: {e}"}
+
+            payload = json.dumps(response).encode()
+            writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                         f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def expire_sessions(self):
+        """Ends games idle for longer than --session_timeout so abandoned ones do not pile up"""
+        while True:
+            await asyncio.sleep(min(self.args.session_timeout / 2, 60))
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                # a game waiting on its AI is not idle
+                if session.search_task is None and now - session.last_active > self.args.session_timeout:
+                    self.delete_game(session)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, self.args.host, self.args.port)
+        print("Serving on", ", ".join(str(sock.getsockname()) for sock in server.sockets), flush=True)
+        expiry = asyncio.ensure_future(self.expire_sessions())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry.cancel()
+            self.executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8486, type=int)
+    parser.add_argument("-j", "--jobs", default=4, help="search worker processes", type=int)
+    parser.add_argument("-t", "--time_limit_ms", default=1000, help="default think time per AI move", type=int)
+    parser.add_argument("--max_time_limit_ms", default=10000, help="largest think time a game may ask for", type=int)
+    parser.add_argument("--max_queued", default=256, help="searches allowed to wait for a worker before new moves are refused", type=int)
+    parser.add_argument("--session_timeout", default=3600, help="seconds a game may sit untouched before it is ended", type=float)
+    parser.add_argument("--cache_entries", default=4000000, help="state cache entries shared by all sessions across all workers, each worker's evaluation cache gets the same share", type=int)
+    parser.add_argument("-s", "--selective", default="", help="comma separated selective search options: lmr, null, futility")
+
+    args = parser.parse_args()
+    try:
+        selective_search_options(args.selective)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cache_entries < 0:
+        parser.error("--cache_entries must not be negative")
+
+    try:
+        asyncio.run(GameServer(args).serve())
+    except KeyboardInterrupt:
+        pass
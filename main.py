@@ -1,6 +1,9 @@
 import argparse
 from datetime import datetime, timedelta
 from game import ONITAMA_CARDS, Game, OnitamaAI, Point
+from game.ai import selective_search_options
+from game.record import HUMAN, GameRecordWriter
+from game.solver import DEFAULT_MAX_NODES, ProofNumberSolver
 
 
 def run_game(args):
@@ -13,11 +16,25 @@ def run_game(args):
     else:
         g = Game()
 
-    ai = OnitamaAI(g, 1 - human, args.evaluation)
+    ai = OnitamaAI(g, 1 - human, args.evaluation, solver_nodes=args.solver_nodes,
+                   **selective_search_options(args.selective))
     human_id = human * 2 - 1
 
     print("Human is", "red" if human == 0 else "blue")
 
+    recorder = None
+    if args.record:
+        recorder = GameRecordWriter(args.record)
+        red_player, blue_player = (HUMAN, args.evaluation) if human == 0 else (args.evaluation, HUMAN)
+        red_selective, blue_selective = ("", args.selective) if human == 0 else (args.selective, "")
+        recorder.start_game(g, red_player, blue_player, time_limit_ms, solver_nodes=args.solver_nodes,
+                            red_selective=red_selective, blue_selective=blue_selective)
+
+    def end_recording(winner):
+        if recorder:
+            recorder.end_game(winner)
+            recorder.close()
+
     for i in range(max_turns):
         print("Turn", i // 2 + 1, "red" if g.current_player == 0 else "blue")
         print(g.visualize())
@@ -29,9 +46,25 @@ def run_game(args):
                 legal_moves = list(g.legal_moves())
                 move_str = input("Enter your move. Format: card start end (e.g. tiger c1 c3). "
                                  "Type 'quit' to quit. Type 'hint [depth]' for the ai's suggestion. "
+                                 "Type 'solve [nodes]' to look for a forced win or loss. "
                                  "Type 'debug' to open an interactive console.\n> ")
                 if move_str == "quit":
+                    end_recording(0)
                     return
+                elif move_str.startswith("solve"):
+                    max_nodes = args.solver_nodes or DEFAULT_MAX_NODES
+                    try:
+                        max_nodes = int(move_str[len("solve "):])
+                    except ValueError:
+                        pass
+                    now = datetime.now()
+                    result = ProofNumberSolver(max_nodes=max_nodes).solve(g)
+                    print("Solver result:", result.outcome, "for", "red" if g.current_player == 0 else "blue",
+                          f"({result.nodes} nodes)")
+                    if result.line:
+                        print("Line:", ", ".join(map(str, result.line)))
+                    print("Solver took", (datetime.now() - now).total_seconds(), "s")
+                    continue
                 elif move_str.startswith("hint"):
                     depth_limit = None
                     try:
@@ -41,11 +74,17 @@ def run_game(args):
                     print("AI is thinking...")
                     now = datetime.now()
                     if depth_limit is None:
-                        ai_move, best_score, depth = ai.decide_move(think_time=time_limit_ms, verbose=args.verbose)
+                        moves = ai.evaluate_moves(1000, time_limit_ms, multipv=args.multipv)
                     else:
-                        ai_move, best_score, depth = ai.decide_move(
-                            think_time=1000000, depth_limit=depth_limit, verbose=args.verbose)
+                        moves = ai.evaluate_moves(depth_limit, 1000000, multipv=args.multipv)
+                    if args.verbose:
+                        ai.print_moves(moves)
+                    ai_move, best_score, depth = ai.best_move(moves)
                     print("AI recommends", ai_move, f"(Evaluation: {best_score} at depth {depth})")
+                    if args.multipv > 1:
+                        for rank, (move, score, move_depth) in enumerate(ai.ranked_moves(moves, args.multipv)):
+                            line = " ".join(map(str, ai.principal_variation(move, move_depth)))
+                            print(f"{rank + 1}. {move} (Evaluation: {score} at depth {move_depth}) line: {line}")
                     print("AI took", (datetime.now() - now).total_seconds(), "s")
                     print(g.visualize())
                     continue
@@ -68,25 +107,33 @@ def run_game(args):
                 print("Invalid move. Valid moves:", ", ".join(map(str, legal_moves)))
             
             g.apply_move(human_move)
+            if recorder:
+                recorder.record_move(human_move)
 
             if g.determine_winner() == human_id:
                 print(g.visualize())
                 print("Human wins!")
+                end_recording(human_id)
                 return
         else:
             print("AI is thinking...")
             now = datetime.now()
+            ai.nodes = 0
             ai_move, best_score, depth = ai.decide_move(think_time=time_limit_ms, verbose=args.verbose)
             print("AI plays", ai_move, f"(Evaluation: {best_score} at depth {depth})")
             g.apply_move(ai_move)
+            if recorder:
+                recorder.record_move(ai_move, best_score, depth, ai.nodes)
             print("AI took", (datetime.now() - now).total_seconds(), "s")
 
             if g.determine_winner() == -human_id:
                 print(g.visualize())
                 print("AI wins!")
+                end_recording(-human_id)
                 return
     print(g.visualize())
     print("Draw due to round limit")
+    end_recording(0)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -95,8 +142,12 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--time_limit_ms", default=10000, type=int)
     parser.add_argument("-m", "--max_turns", default=50, type=int)
     parser.add_argument("-v", "--verbose", default=False, action="store_true")
+    parser.add_argument("-r", "--record", default=None, help="append the game to this binary game record file")
+    parser.add_argument("-s", "--selective", default="", help="comma separated selective search options: lmr, null, futility")
+    parser.add_argument("--solver_nodes", default=0, help="node budget of the forced win search run before each AI move, 0 to skip it", type=int)
+    parser.add_argument("--multipv", default=3, help="number of best moves given exact scores by hint", type=int)
     parser.add_argument("-e", "--evaluation", default=0, help="0 for piece evaluation, 1 for centre priority, 2 for combination of both", type=int)
 
     args = parser.parse_args()
 
-    run_game(args)
\ No newline at end of file
+    run_game(args)
\ No newline at end of file